@@ -17,7 +17,7 @@ oparlsync = OparlSync()
 
 args = sys.argv
 
-global_action = ['daemon', 'single', 'queue']
+global_action = ['daemon', 'single', 'queue', 'reindex']
 
 if len(args) < 2:
     sys.exit('usage: python manage.py %s' % '|'.join(global_action))
@@ -75,3 +75,6 @@ if args[1] == 'single':
         sys.exit('usage: python manage.py single $module $body $mongoid|$oparlid(optional)')
 
     oparlsync.single(args[2], args[3], *args[4:])
+
+if args[1] == 'reindex':
+    oparlsync.reindex()
@@ -16,11 +16,16 @@ import json
 import time
 import logging
 import pymongo
+import codecs
 import smtplib
 import requests
+import tempfile
+import threading
 import mongoengine
 import subprocess
 from copy import deepcopy
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from minio import Minio
 from elasticsearch import Elasticsearch
 from minio.policy import Policy
@@ -29,6 +34,7 @@ from urllib3.exceptions import MaxRetryError, ClosedPoolError
 from mongoengine.connection import disconnect as mongoengine_disconnect
 
 from .config import get_config
+from .models import File
 
 
 
@@ -41,6 +47,7 @@ class BaseTask():
         self.config = get_config(os.getenv('APPLICATION_MODE', 'DEVELOPMENT'))()
         self.init_logging()
         self.init_db()
+        self.init_http()
         self.default_config = {
             "id": "",
             "rgs": "",
@@ -119,11 +126,85 @@ class BaseTask():
             self.es = Elasticsearch(
                 self.config.ES_HOSTS
             )
+    def init_http(self):
+        # one session for all http requests of a task, so tcp and tls connections get reused
+        self.http_statistics = {
+            'requests': 0,
+            'retries': 0,
+            'errors': 0
+        }
+        # connections of host pools urllib3 already evicted, so they still count in get_http_statistics
+        self.http_evicted_connections = 0
+        self.http_statistics_lock = threading.Lock()
+        retry = Retry(
+            total=self.config.HTTP_RETRIES,
+            backoff_factor=self.config.HTTP_BACKOFF_FACTOR,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False
+        )
+        self.http_adapter = HTTPAdapter(
+            pool_connections=self.config.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=self.config.HTTP_POOL_SIZE,
+            max_retries=retry
+        )
+        pools = self.http_adapter.poolmanager.pools
+        dispose_pool = pools.dispose_func
+        def dispose_counted_pool(pool):
+            with self.http_statistics_lock:
+                self.http_evicted_connections += pool.num_connections
+            if dispose_pool:
+                dispose_pool(pool)
+        pools.dispose_func = dispose_counted_pool
+        self.http = requests.Session()
+        self.http.mount('http://', self.http_adapter)
+        self.http.mount('https://', self.http_adapter)
+        self.http.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'User-Agent': '%s/%s' % (self.config.PROJECT_NAME, self.config.PROJECT_VERSION)
+        })
+
+    def http_get(self, url, **kwargs):
+        """
+        GET request using the shared session. Returns the response or False if
+        the server could not be reached even after all retries.
+        """
+        if 'timeout' not in kwargs:
+            kwargs['timeout'] = self.config.HTTP_TIMEOUT
+        self.count_http('requests')
+        try:
+            r = self.http.get(url, **kwargs)
+        except requests.exceptions.RequestException as err:
+            self.count_http('errors')
+            self.datalog.warn('http request to %s failed: %s' % (url, err))
+            return False
+        if r.raw.retries:
+            self.count_http('retries', len(r.raw.retries.history))
+        return r
+
+    def count_http(self, key, value=1):
+        with self.http_statistics_lock:
+            self.http_statistics[key] += value
+
+    def get_http_statistics(self):
+        with self.http_statistics_lock:
+            statistics = dict(self.http_statistics)
+            statistics['connections'] = self.http_evicted_connections
+        # urllib3 counts new connections per host pool
+        pools = self.http_adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool:
+                statistics['connections'] += pool.num_connections
+        # every request and retry which did not open a new connection reused one
+        statistics['reused'] = max(0, statistics['requests'] + statistics['retries'] - statistics['connections'])
+        return statistics
+
     def close(self):
         self.close_connections()
         self.close_logging()
 
     def close_connections(self):
+        self.http.close()
         self.db_raw_client.close()
         self.db_raw_client = None
         mongoengine_disconnect()
@@ -137,31 +218,101 @@ class BaseTask():
             self.datalog.removeHandler(handler)
 
     def get_file(self, file, save_to):
+        """
+        Writes the binary of file to save_to, which is either a path or an open binary file.
+        """
         if file.storedAtMirror:
             if not file.mirrorAccessUrl:
                 return False
-            r = requests.get(file.mirrorAccessUrl, stream=True)
-            if r.status_code != 200:
+            r = self.http_get(file.mirrorAccessUrl, stream=True)
+            if not r or r.status_code != 200:
                 return False
-            with open(save_to, 'wb') as file_data:
-                for chunk in r.iter_content(chunk_size=32 * 1024):
-                    if chunk:
-                        file_data.write(chunk)
-            return True
+            chunks = r.iter_content(chunk_size=32 * 1024)
         else:
             try:
                 data = self.s3.get_object(
                     self.config.S3_BUCKET,
-                    "files/%s/%s" % (file.body.id, file.id)
+                    self.get_file_object_name(file.body.id, file.id, file.binaryChecksum)
                 )
             except NoSuchKey:
                 return False
+            chunks = data.stream(32 * 1024)
+        if isinstance(save_to, str):
             with open(save_to, 'wb') as file_data:
-                for chunk in data.stream(32 * 1024):
-                    file_data.write(chunk)
-            return True
+                self.write_chunks(file_data, chunks)
+        else:
+            self.write_chunks(save_to, chunks)
+        return True
+
+    def write_chunks(self, file_data, chunks):
+        for chunk in chunks:
+            if chunk:
+                file_data.write(chunk)
+
+    def get_file_buffer(self, file):
+        """
+        Like get_file, but returns an anonymous in memory file instead of writing to disk. Tools get it as
+        self.get_buffer_path(buffer), it has to be passed to execute via pass_fds. Returns False if the file
+        is missing.
+        """
+        buffer = self.create_buffer(str(file.id))
+        if not self.get_file(file, buffer):
+            buffer.close()
+            return False
+        buffer.flush()
+        buffer.seek(0)
+        return buffer
+
+    def create_buffer(self, name):
+        # memfd lives in RAM and needs no cleanup, tmpfs is the fallback for older pythons
+        if hasattr(os, 'memfd_create'):
+            return os.fdopen(os.memfd_create(name), 'w+b')
+        buffer_dir = self.config.BUFFER_DIR if os.path.isdir(self.config.BUFFER_DIR) else None
+        return tempfile.TemporaryFile(dir=buffer_dir)
+
+    def get_buffer_path(self, buffer):
+        return '/dev/fd/%s' % buffer.fileno()
 
-    def execute(self, cmd, body_id):
+    def get_file_object_name(self, body_id, file_id, checksum=None):
+        """
+        Deduplicated binaries are stored by their sha512 checksum, all others by their File id.
+        """
+        if checksum:
+            return "files/%s/sha512/%s" % (body_id, checksum)
+        return "files/%s/%s" % (body_id, file_id)
+
+    def get_duplicate_file(self, file, status_field, status_values):
+        """
+        Returns another File with the same binary which has already been processed, so the result can be reused.
+        """
+        if not file.binaryChecksum:
+            return None
+        return File.objects(
+            body=file.body.id,
+            binaryChecksum=file.binaryChecksum,
+            id__ne=file.id,
+            **{'%s__in' % status_field: status_values}
+        ).no_cache().first()
+
+    def get_watermark(self, body, stage):
+        """
+        Returns how far stage got at body, None if there is no watermark.
+        """
+        if not body.watermark:
+            return None
+        return body.watermark.get(stage)
+
+    def set_watermark(self, body, stage, value):
+        """
+        Stores the watermark of stage at body, None removes it.
+        """
+        if value is None:
+            update = {'$unset': {'watermark.%s' % stage: 1}}
+        else:
+            update = {'$set': {'watermark.%s' % stage: value}}
+        self.db_raw[body._object_db_name].update_one({'_id': body.id}, update)
+
+    def execute(self, cmd, body_id, pass_fds=()):
         new_env = os.environ.copy()
         new_env['XDG_RUNTIME_DIR'] = '/tmp/'
         try:
@@ -169,7 +320,8 @@ class BaseTask():
                 cmd.split(' '),
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                env=new_env
+                env=new_env,
+                pass_fds=pass_fds
             ).communicate(timeout=self.config.SUBPROCESS_TIMEOUT)
         except subprocess.TimeoutExpired:
             self.send_mail(
@@ -185,6 +337,52 @@ class BaseTask():
             self.datalog.debug("pdf output at command %s; output: %s" % (cmd, error))
         return output
 
+    def execute_text(self, cmd, body_id, pass_fds=()):
+        """
+        Like execute, but returns stdout as text. The output is decoded while it is read, so it is never
+        held in memory as bytes and as text at the same time.
+        """
+        new_env = os.environ.copy()
+        new_env['XDG_RUNTIME_DIR'] = '/tmp/'
+        timed_out = []
+
+        def kill(process):
+            timed_out.append(True)
+            process.kill()
+
+        with tempfile.TemporaryFile() as error_file:
+            process = subprocess.Popen(
+                cmd.split(' '),
+                stdout=subprocess.PIPE,
+                stderr=error_file,
+                env=new_env,
+                pass_fds=pass_fds
+            )
+            timer = threading.Timer(self.config.SUBPROCESS_TIMEOUT, kill, [process])
+            timer.start()
+            decoder = codecs.getincrementaldecoder('utf-8')('replace')
+            text = []
+            try:
+                for chunk in iter(lambda: process.stdout.read(64 * 1024), b''):
+                    text.append(decoder.decode(chunk))
+                text.append(decoder.decode(b'', final=True))
+                process.stdout.close()
+                process.wait()
+            finally:
+                timer.cancel()
+            if timed_out:
+                self.send_mail(
+                    self.config.ADMINS,
+                    'critical error at oparl-mirror',
+                    'command %s at %s takes forever' % (cmd, body_id)
+                )
+                return False
+            error_file.seek(0)
+            error = error_file.read().decode(errors='replace')
+            if error.strip() != '' and 'WARNING **: clutter failed 0, get a life.' not in error:
+                self.datalog.debug("pdf output at command %s; output: %s" % (cmd, error))
+        return ''.join(text)
+
     def get_body_config(self, body_id=False, filename=False):
         if not filename:
             filename = '%s.json' % (body_id)
@@ -27,6 +27,8 @@ class DefaultConfig(object):
     TMP_THUMBNAIL_DIR = os.path.abspath(os.path.join(TMP_DIR, 'thumbnails'))
     TMP_OSM_DIR = os.path.abspath(os.path.join(TMP_DIR, 'osm'))
     TMP_REGION_DIR = os.path.abspath(os.path.join(TMP_DIR, 'region'))
+    # tmpfs for in memory processing if memfd is not available
+    BUFFER_DIR = '/dev/shm'
 
     USE_MIRROR = False
     OPARL_MIRROR_PREFIX = ''
@@ -39,9 +41,43 @@ class DefaultConfig(object):
     MONGO_DB_NAME = 'oparl'
 
     THREADS_NETWORK_MAX = 4
+    # max seconds an idle worker blocks waiting for a job, this is also the shutdown delay
+    QUEUE_WAIT_TIME = 1
+    # seconds after which the lock of a job counts as stale, e.g. of a killed worker. running jobs
+    # refresh their lock every QUEUE_HEARTBEAT_TIME seconds.
+    QUEUE_LOCK_TIMEOUT = 300
+    QUEUE_HEARTBEAT_TIME = 60
+    # seconds after their last change when pipeline runs are removed
+    PIPELINE_RUN_TTL = 7 * 24 * 3600
     THREADS_LOCAL_MAX = 4
     GET_URL_WAIT_TIME = 0.2
+    # number of requests which may be sent to one host without waiting
+    GET_URL_BURST = 1
+    # prefetch list pages and sync organizations, persons, meetings and papers at the same time
+    OPARL_CONCURRENT_SYNC = False
+    # max number of cached originalId -> ObjectId entries per object type
+    OBJECT_CACHE_MAX_SIZE = 1000000
+
+    # (connect timeout, read timeout) in seconds
+    HTTP_TIMEOUT = (10, 120)
+    HTTP_RETRIES = 3
+    HTTP_BACKOFF_FACTOR = 0.5
+    # number of hosts and connections per host kept in the http pool
+    HTTP_POOL_CONNECTIONS = 10
+    HTTP_POOL_SIZE = 10
+    # number of parallel file downloads / uploads and max number of files waiting for them
+    FILE_DOWNLOAD_THREADS = 4
+    FILE_DOWNLOAD_QUEUE_SIZE = 64
+    # files without content length are buffered in memory up to this size before using TMP_FILE_DIR
+    FILE_SPOOL_MAX_SIZE = 16 * 1024 * 1024
+    # store identical binaries of a body just once at files/<body>/sha512/<checksum>. the frontend has to
+    # resolve File.binaryChecksum if this is enabled.
+    FILE_DEDUPLICATION = False
     ENABLE_PROCESSING = True
+    # number of files fetched at once by the processing stages
+    PROCESSING_BATCH_SIZE = 500
+    # hand binaries to pdftotext, abiword and ghostscript in memory instead of writing them to the TMP dirs
+    PROCESSING_IN_MEMORY = False
 
     S3_ENDPOINT = '127.0.0.1:9000'
     S3_ACCESS_KEY = ''
@@ -53,6 +89,15 @@ class DefaultConfig(object):
 
     ES_ENABLED = True
     ES_HOSTS = []
+    # documents / bytes per bulk request and parallel bulk requests while indexing
+    ES_BULK_CHUNK_SIZE = 500
+    ES_BULK_MAX_BYTES = 10 * 1024 * 1024
+    ES_BULK_THREADS = 4
+    # imports with more documents than this run with the index refresh turned off
+    ES_BULK_REFRESH_THRESHOLD = 1000
+    # bodies loaded in parallel by manage.py reindex, and how long its lock holds if the process dies
+    ES_REINDEX_THREADS = 4
+    ES_REINDEX_LOCK_LEASE = 24 * 3600
 
     ADMINS = []
     MAIL_FROM = ''
@@ -66,11 +111,17 @@ class DefaultConfig(object):
     PDFTOTEXT_COMMAND = '/usr/bin/pdftotext'
     ABIWORD_COMMAND = '/usr/bin/abiword'
     GHOSTSCRIPT_COMMAND = '/usr/bin/gs'
-    JPEGOPTIM_PATH = '/usr/bin/jpegoptim'
+    PDFINFO_COMMAND = '/usr/bin/pdfinfo'
     OSMOSIS_PATH = os.path.join(BASE_DIR, 'street_import', 'osmosis', 'bin', 'osmosis')
     REL2POLY_PATH = os.path.join(BASE_DIR, 'street_import', 'rel2poly.pl')
 
     THUMBNAIL_SIZES = [1200, 800, 300, 150]
+    # pages rendered by one ghostscript call, the calls run in THREADS_LOCAL_MAX threads
+    THUMBNAIL_PAGES_PER_JOB = 10
+    # parallel thumbnail uploads, minio keeps up to 10 connections per host open
+    THUMBNAIL_UPLOAD_THREADS = 8
+    # store all pages of one size in a single <size>.pack object, File.thumbnail holds the offsets
+    THUMBNAIL_PACKED = False
 
 
 class DevelopmentConfig(DefaultConfig):
@@ -10,10 +10,19 @@ Redistribution and use in source and binary forms, with or without modification,
 THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import os
+import copy
 import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from bson import ObjectId
+from mongoengine import Q
+from elasticsearch import helpers
 from ..models import *
 from ..base_task import BaseTask
+from ..mongoqueue import MongoLock
 from mongoengine.base.datastructures import BaseList
 
 
@@ -23,6 +32,8 @@ class ElasticsearchImport(BaseTask):
         'mongodb',
         'elasticsearch'
     ]
+    # watermarks collected during a reindex, set after the alias swap
+    watermarks = None
 
 
     def __init__(self, body_id):
@@ -35,56 +46,48 @@ class ElasticsearchImport(BaseTask):
     def run(self, body_id, *args):
         if not (self.config.ENABLE_PROCESSING and self.config.ES_ENABLED):
             return
+        if self.reindex_running():
+            # the reindex loads every body and sets the watermarks afterwards, so nothing gets lost
+            self.datalog.info('ElasticSearch reindex is running, import of body %s skipped' % body_id)
+            return
         self.body = Body.objects(uid=body_id).no_cache().first()
         if not self.body:
             return
-        self.statistics = {
-            'created': 0,
-            'updated': 0
-        }
+        # everything modified since the watermark of an index is indexed again, 'full' indexes everything.
+        # the watermark is the start of the last sync, or of this import if this is earlier. upstream
+        # modified dates are compared to the sync time, local *Generated dates are in local time, so the
+        # earliest candidate is used to never miss anything.
+        self.full = 'full' in args
+        self.watermark = min([value for value in [self.body.lastSync, datetime.utcnow(), datetime.now()] if value])
         self.street_index()
         self.paper_location_index()
         self.paper_index()
         self.body = None
         self.es = None
 
-    def street_index(self):
-
-        if not self.es.indices.exists_alias(name='street-latest'):
-            now = datetime.utcnow()
-            index_name = 'street-' + now.strftime('%Y%m%d-%H%M')
-
-            mapping = self.es_mapping_generator(Street, 'deref_street')
-
-            mapping['properties']['autocomplete'] = {
-                "type": 'text',
-                "analyzer": "autocomplete_import_analyzer",
-                "search_analyzer": "autocomplete_search_analyzer"
-            }
-            mapping['properties']['legacy'] = {
-                'type': 'boolean'
-            }
-
-
-            self.es.indices.create(index=index_name, body={
-                'settings': self.es_settings(),
-                'mappings': {
-                    'street': mapping
-                }
-            })
-
-            self.es.indices.update_aliases({
-                'actions': {
-                    'add': {
-                        'index': index_name,
-                        'alias': 'street-latest'
-                    }
-                }
-            })
+    def street_index(self, index_name=None):
+        if index_name:
+            created = True
         else:
-            index_name = list(self.es.indices.get_alias('street-latest'))[0]
-
-        for street in Street.objects(region=self.body.region).no_cache():
+            index_name, created = self.get_index('street-latest', 'street', self.street_mapping)
+
+        since = self.get_index_watermark('elasticsearch_street', created)
+        if since:
+            # streets have no modified date, so new streets are found by their ObjectId and changed ones by their location
+            location_ids = [location.id for location in Location.objects(region=self.body.region, modified__gte=since).only('id').no_cache()]
+            street_ids = [street.id for street in Street.objects(Q(id__gte=ObjectId.from_datetime(since)) | Q(location__in=location_ids), region=self.body.region).only('id').no_cache()]
+            streets = self.get_objects_by_ids(Street, street_ids)
+            count = len(street_ids)
+        else:
+            streets = Street.objects(region=self.body.region).no_cache()
+            count = streets.count()
+        statistics = self.bulk_index(index_name, self.street_actions(index_name, streets), count)
+        self.datalog.info('ElasticSearch street import successfull: %s created, %s updated, %s failed' % (
+            statistics['created'], statistics['updated'], statistics['failed']))
+        self.set_index_watermark('elasticsearch_street', statistics, 'street-latest', index_name)
+
+    def street_actions(self, index_name, streets):
+        for street in streets:
             street_dict = street.to_dict(deref='deref_street', format_datetime=True, delete='delete_street', clean_none=True)
 
             if 'geojson' in street_dict:
@@ -119,133 +122,82 @@ class ElasticsearchImport(BaseTask):
 
             street_dict['legacy'] = bool(street.region.legacy)
 
-            new_doc = self.es.index(
-                index=index_name,
-                id=str(street.id),
-                doc_type='street',
-                body=street_dict
-            )
-
-            if new_doc['result'] in ['created', 'updated']:
-                self.statistics[new_doc['result']] += 1
-            else:
-                self.datalog.warn('Unknown result at %s' % street.id)
-        self.datalog.info('ElasticSearch street import successfull: %s created, %s updated' % (
-            self.statistics['created'], self.statistics['updated']))
-
-
-    def paper_index(self):
-
-        if not self.es.indices.exists_alias(name='paper-latest'):
-            now = datetime.utcnow()
-            index_name = 'paper-' + now.strftime('%Y%m%d-%H%M')
-
-            mapping = self.es_mapping_generator(Paper, 'deref_paper')
-            mapping['properties']['region'] = {
-                'type': 'text'
+            yield {
+                '_index': index_name,
+                '_type': 'street',
+                '_id': str(street.id),
+                '_source': street_dict
             }
 
-
-            self.es.indices.create(index=index_name, body={
-                'settings': self.es_settings(),
-                'mappings': {
-                    'paper': mapping
-                }
-            })
-
-            self.es.indices.update_aliases({
-                'actions': {
-                    'add': {
-                        'index': index_name,
-                        'alias': 'paper-latest'
-                    }
-                }
-            })
-
+    def paper_index(self, index_name=None):
+        if index_name:
+            created = True
         else:
-            index_name = list(self.es.indices.get_alias('paper-latest'))[0]
-
-
-        regions = []
-        region = self.body.region
-        while (region):
-            regions.append(str(region.id))
-            region = region.parent
+            index_name, created = self.get_index('paper-latest', 'paper', self.paper_mapping)
 
-        for paper in Paper.objects(body=self.body).no_cache():
+        since = self.get_index_watermark('elasticsearch_paper', created)
+        if since:
+            paper_ids = self.get_dirty_paper_ids(since)
+            papers = self.get_objects_by_ids(Paper, paper_ids)
+            count = len(paper_ids)
+        else:
+            papers = Paper.objects(body=self.body).no_cache()
+            count = papers.count()
+        statistics = self.bulk_index(index_name, self.paper_actions(index_name, papers, self.get_region_ids()), count)
+        self.datalog.info('ElasticSearch paper import successfull: %s created, %s updated, %s deleted, %s failed' % (
+            statistics['created'], statistics['updated'], statistics['deleted'], statistics['failed']))
+        self.set_index_watermark('elasticsearch_paper', statistics, 'paper-latest', index_name)
+
+    def paper_actions(self, index_name, papers, regions):
+        for paper in papers:
             if paper.deleted:
-                self.es.delete(
-                    index=index_name,
-                    id=str(paper.id),
-                    doc_type='paper',
-                    ignore=[400, 404]
-                )
+                yield {
+                    '_op_type': 'delete',
+                    '_index': index_name,
+                    '_type': 'paper',
+                    '_id': str(paper.id)
+                }
                 continue
             paper_dict = paper.to_dict(deref='deref_paper', format_datetime=True, delete='delete_paper', clean_none=True)
             paper_dict['body_name'] = paper.body.name
             paper_dict['region'] = regions
             paper_dict['legacy'] = 'legacy' in paper_dict
 
-            new_doc = self.es.index(
-                index=index_name,
-                id=str(paper.id),
-                doc_type='paper',
-                body=paper_dict
-            )
-            if new_doc['result'] in ['created', 'updated']:
-                self.statistics[new_doc['result']] += 1
-            else:
-                self.datalog.warn('Unknown result at %s' % paper.id)
-        self.datalog.info('ElasticSearch paper import successfull: %s created, %s updated' % (
-            self.statistics['created'], self.statistics['updated']))
-
-    def paper_location_index(self):
-
-        if not self.es.indices.exists_alias(name='paper-location-latest'):
-            now = datetime.utcnow()
-            index_name = 'paper-location-' + now.strftime('%Y%m%d-%H%M')
-
-            mapping = self.es_mapping_generator(Location, 'deref_paper_location')
-            mapping['properties']['region'] = {
-                'type': 'text'
-            }
-            mapping['properties']['legacy'] = {
-                'type': 'boolean'
+            yield {
+                '_index': index_name,
+                '_type': 'paper',
+                '_id': str(paper.id),
+                '_source': paper_dict
             }
 
-            self.es.indices.create(index=index_name, body={
-                'settings': self.es_settings(),
-                'mappings': {
-                    'location': mapping
-                }
-            })
-
-            self.es.indices.update_aliases({
-                'actions': {
-                    'add': {
-                        'index': index_name,
-                        'alias': 'paper-location-latest'
-                    }
-                }
-            })
-
+    def paper_location_index(self, index_name=None):
+        if index_name:
+            created = True
         else:
-            index_name = list(self.es.indices.get_alias('paper-location-latest'))[0]
+            index_name, created = self.get_index('paper-location-latest', 'location', self.paper_location_mapping)
 
-        regions = []
-        region = self.body.region
-        while (region):
-            regions.append(str(region.id))
-            region = region.parent
-
-        for location in Location.objects(body=self.body).no_cache():
+        since = self.get_index_watermark('elasticsearch_paper_location', created)
+        if since:
+            location_ids = self.get_dirty_location_ids(since)
+            locations = self.get_objects_by_ids(Location, location_ids)
+            count = len(location_ids)
+        else:
+            locations = Location.objects(body=self.body).no_cache()
+            count = locations.count()
+        statistics = self.bulk_index(index_name, self.paper_location_actions(index_name, locations, self.get_region_ids()), count)
+        self.datalog.info('ElasticSearch paper-location import successfull: %s created, %s updated, %s deleted, %s failed' % (
+            statistics['created'], statistics['updated'], statistics['deleted'], statistics['failed']))
+        self.set_index_watermark('elasticsearch_paper_location', statistics, 'paper-location-latest', index_name)
+
+    def paper_location_actions(self, index_name, locations, regions):
+        for location in locations:
             if location.deleted:
-                self.es.delete(
-                    index=index_name,
-                    id=str(location.id),
-                    doc_type='location',
-                    ignore=[400, 404]
-                )
+                yield {
+                    '_op_type': 'delete',
+                    '_index': index_name,
+                    '_type': 'location',
+                    '_id': str(location.id)
+                }
                 continue
             location_dict = location.to_dict(deref='deref_paper_location', format_datetime=True, delete='delete_paper_location', clean_none=True)
             location_dict['region'] = regions
@@ -276,18 +228,354 @@ class ElasticsearchImport(BaseTask):
 
             location_dict['legacy'] = bool(location.region.legacy)
 
-            new_doc = self.es.index(
-                index=index_name,
-                id=str(location.id),
-                doc_type='location',
-                body=location_dict
-            )
-            if new_doc['result'] in ['created', 'updated']:
-                self.statistics[new_doc['result']] += 1
-            else:
-                self.datalog.warn('Unknown result at %s' % location.id)
-        self.datalog.info('ElasticSearch paper-location import successfull: %s created, %s updated' % (
-        self.statistics['created'], self.statistics['updated']))
+            yield {
+                '_index': index_name,
+                '_type': 'location',
+                '_id': str(location.id),
+                '_source': location_dict
+            }
+
+    def street_mapping(self):
+        mapping = self.es_mapping_generator(Street, 'deref_street')
+        mapping['properties']['autocomplete'] = {
+            "type": 'text',
+            "analyzer": "autocomplete_import_analyzer",
+            "search_analyzer": "autocomplete_search_analyzer"
+        }
+        mapping['properties']['legacy'] = {
+            'type': 'boolean'
+        }
+        return mapping
+
+    def paper_mapping(self):
+        mapping = self.es_mapping_generator(Paper, 'deref_paper')
+        mapping['properties']['region'] = {
+            'type': 'text'
+        }
+        return mapping
+
+    def paper_location_mapping(self):
+        mapping = self.es_mapping_generator(Location, 'deref_paper_location')
+        mapping['properties']['region'] = {
+            'type': 'text'
+        }
+        mapping['properties']['legacy'] = {
+            'type': 'boolean'
+        }
+        return mapping
+
+    def region_mapping(self):
+        mapping = self.es_mapping_generator(Region, deref='deref_region', delete='delete_region')
+        mapping['properties']['body_count'] = {
+            'type': 'integer'
+        }
+        return mapping
+
+    def region_index(self, index_name=None):
+        if not index_name:
+            index_name, created = self.get_index('region-latest', 'region', self.region_mapping)
+        regions = Region.objects().no_cache()
+        statistics = self.bulk_index(index_name, self.region_actions(index_name, regions), regions.count())
+        self.datalog.info('ElasticSearch region import successfull: %s created, %s updated, %s failed' % (
+            statistics['created'], statistics['updated'], statistics['failed']))
+
+    def region_actions(self, index_name, regions):
+        for region in regions:
+            region_dict = region.to_dict()
+            region_dict['geosearch'] = {
+                'type': 'envelope',
+                'coordinates': region_dict['bounds']
+            }
+            region_dict['geojson']['properties']['legacy'] = region.legacy
+            region_dict['geojson']['properties']['bodies'] = []
+            region_dict['body_count'] = len(region.body)
+            for body in region.body:
+                region_dict['geojson']['properties']['bodies'].append(str(body.id))
+
+            region_dict['geojson'] = json.dumps(region_dict['geojson'])
+            del region_dict['bounds']
+            region_dict['legacy'] = bool(region.legacy)
+
+            yield {
+                '_index': index_name,
+                '_type': 'region',
+                '_id': str(region.id),
+                '_source': region_dict
+            }
+
+    def get_index(self, alias, doc_type, mapping):
+        """
+        Returns the index behind alias and if it was just created, which happens if the alias is missing.
+        """
+        if self.es.indices.exists_alias(name=alias):
+            return list(self.es.indices.get_alias(alias))[0], False
+        index_name = self.create_index(alias[:-len('-latest')], doc_type, mapping())
+        self.es.indices.update_aliases({
+            'actions': {
+                'add': {
+                    'index': index_name,
+                    'alias': alias
+                }
+            }
+        })
+        return index_name, True
+
+    def create_index(self, prefix, doc_type, mapping, settings=None):
+        now = datetime.utcnow()
+        index_name = prefix + '-' + now.strftime('%Y%m%d-%H%M')
+        if self.es.indices.exists(index=index_name):
+            index_name = prefix + '-' + now.strftime('%Y%m%d-%H%M%S')
+        self.es.indices.create(index=index_name, body={
+            'settings': settings if settings else self.es_settings(),
+            'mappings': {
+                doc_type: mapping
+            }
+        })
+        return index_name
+
+    def reindex(self):
+        """
+        Builds fresh indexes with replicas and refresh turned off, loads all active bodies into them in
+        ES_REINDEX_THREADS threads, restores the settings and swaps the *-latest aliases to them in one
+        atomic request. The old indexes are deleted afterwards, so searches keep working all the time.
+        This is a global command, just one reindex may run at a time.
+        """
+        if not (self.config.ENABLE_PROCESSING and self.config.ES_ENABLED):
+            return
+        lock = MongoLock(self.db_raw.lock, 'elasticsearch_reindex', self.config.ES_REINDEX_LOCK_LEASE)
+        if not lock.acquire():
+            self.datalog.warn('ElasticSearch reindex is running already')
+            return
+        try:
+            self.reindex_locked()
+        finally:
+            lock.release()
+
+    def reindex_locked(self):
+        indexes = OrderedDict([
+            ('region-latest', ('region', self.region_mapping)),
+            ('street-latest', ('street', self.street_mapping)),
+            ('paper-latest', ('paper', self.paper_mapping)),
+            ('paper-location-latest', ('location', self.paper_location_mapping))
+        ])
+        settings = self.es_settings()
+        settings['index']['number_of_replicas'] = 0
+        settings['index']['refresh_interval'] = '-1'
+        index_names = OrderedDict()
+        old_index_names = []
+        self.watermarks = []
+        try:
+            for alias, (doc_type, mapping) in indexes.items():
+                index_names[alias] = self.create_index(alias[:-len('-latest')], doc_type, mapping(), settings)
+            self.datalog.info('ElasticSearch reindex into %s' % ', '.join(index_names.values()))
+
+            self.region_index(index_names['region-latest'])
+            streets_done = set()
+            streets_lock = threading.Lock()
+            with ThreadPoolExecutor(max_workers=self.config.ES_REINDEX_THREADS) as executor:
+                futures = [
+                    executor.submit(self.reindex_body, body, index_names, streets_done, streets_lock)
+                    for body in self.get_reindex_bodies()
+                ]
+                for future in futures:
+                    future.result()
+
+            actions = []
+            for alias, index_name in index_names.items():
+                old_settings = {}
+                if self.es.indices.exists_alias(name=alias):
+                    for old_index_name, old_index in self.es.indices.get_settings(index=alias).items():
+                        old_index_names.append(old_index_name)
+                        old_settings = old_index['settings']['index']
+                        actions.append({'remove': {'index': old_index_name, 'alias': alias}})
+                self.es.indices.put_settings(index=index_name, body={'index': {
+                    'number_of_replicas': old_settings.get('number_of_replicas'),
+                    'refresh_interval': old_settings.get('refresh_interval')
+                }})
+                self.es.indices.refresh(index=index_name)
+                actions.append({'add': {'index': index_name, 'alias': alias}})
+            self.es.indices.update_aliases({'actions': actions})
+        except Exception:
+            # the swap is atomic, so until it succeeded the new indexes are not in use
+            self.datalog.error('ElasticSearch reindex failed, the old indexes stay in place')
+            for index_name in index_names.values():
+                try:
+                    self.es.indices.delete(index=index_name, ignore=[404])
+                except Exception as err:
+                    self.datalog.error('ElasticSearch index %s could not be removed: %s' % (index_name, err))
+            self.watermarks = None
+            raise
+
+        for old_index_name in old_index_names:
+            try:
+                self.es.indices.delete(index=old_index_name, ignore=[404])
+            except Exception as err:
+                self.datalog.error('ElasticSearch old index %s could not be removed: %s' % (old_index_name, err))
+
+        # watermarks are taken before each body is loaded and set after the swap, so changes made while the
+        # reindex ran, when delta imports are skipped, are imported by the next delta import
+        for body, stage, watermark in self.watermarks:
+            self.set_watermark(body, stage, watermark)
+        self.watermarks = None
+        self.datalog.info('ElasticSearch reindex successfull, removed %s' % ', '.join(old_index_names))
+
+    def get_reindex_bodies(self):
+        """
+        Bodies of all active and not legacy body configs, like queue add all.
+        """
+        body_ids = []
+        for filename in os.listdir(self.config.BODY_DIR):
+            if filename[-4:] != 'json':
+                continue
+            body_config = self.get_body_config(filename=filename)
+            if body_config and body_config.get('active') and 'legacy' not in body_config:
+                body_ids.append(body_config['id'])
+        return Body.objects(uid__in=body_ids).no_cache()
+
+    def reindex_body(self, body, index_names, streets_done, streets_lock):
+        # the index methods keep the body in the instance, so every thread gets its own shallow copy which
+        # shares config, logging and connections
+        es_import = copy.copy(self)
+        es_import.body = body
+        es_import.full = True
+        es_import.watermark = min([value for value in [body.lastSync, datetime.utcnow(), datetime.now()] if value])
+        with streets_lock:
+            index_streets = body.region not in streets_done
+            streets_done.add(body.region)
+        if index_streets:
+            es_import.street_index(index_names['street-latest'])
+        es_import.paper_location_index(index_names['paper-location-latest'])
+        es_import.paper_index(index_names['paper-latest'])
+
+    def get_index_watermark(self, stage, created):
+        """
+        Returns since when documents have to be indexed, None for all of them.
+        """
+        if self.full or created:
+            return None
+        return self.get_watermark(self.body, stage)
+
+    def set_index_watermark(self, stage, statistics, alias, index_name):
+        # failed documents are tried again next time
+        if statistics['failed']:
+            return
+        if self.watermarks is not None:
+            self.watermarks.append((self.body, stage, self.watermark))
+            return
+        # a reindex which started or swapped the alias during this import sets the watermarks itself
+        if self.reindex_running() or self.index_replaced(alias, index_name):
+            self.datalog.info('ElasticSearch %s was reindexed during the import, watermark kept' % alias)
+            return
+        self.set_watermark(self.body, stage, self.watermark)
+
+    def reindex_running(self):
+        return self.db_raw.lock.find_one({'_id': 'elasticsearch_reindex', 'ttl': {'$gt': datetime.now()}}) is not None
+
+    def index_replaced(self, alias, index_name):
+        """
+        True if alias does not point to index_name any more. Writes into the deleted old index recreate
+        it without alias, so such a stray index is removed again.
+        """
+        if self.es.indices.exists_alias(name=alias, index=index_name):
+            return False
+        if self.es.indices.exists(index=index_name) and not self.es.indices.get_alias(index=index_name)[index_name]['aliases']:
+            self.es.indices.delete(index=index_name, ignore=[404])
+        return True
+
+    def get_dirty_paper_ids(self, since):
+        """
+        Papers modified since since, plus the papers of Files which are dereferenced into them and got new
+        metadata, text, thumbnails or georeferences since then.
+        """
+        changed = Q(id__gte=ObjectId.from_datetime(since)) | Q(modified__gte=since)
+        paper_ids = set([paper.id for paper in Paper.objects(changed, body=self.body).only('id').no_cache()])
+        files = File.objects(
+            changed | Q(textGenerated__gte=since) | Q(thumbnailGenerated__gte=since) | Q(georeferencesGenerated__gte=since),
+            body=self.body
+        ).only('paper').no_cache().as_pymongo()
+        for file in files:
+            paper_ids.update(file.get('paper', []))
+        return list(paper_ids)
+
+    def get_dirty_location_ids(self, since):
+        """
+        Locations modified since since, plus all Locations of dirty Papers, as Papers are dereferenced into them.
+        """
+        changed = Q(id__gte=ObjectId.from_datetime(since)) | Q(modified__gte=since)
+        location_ids = set([location.id for location in Location.objects(changed, body=self.body).only('id').no_cache()])
+        paper_ids = self.get_dirty_paper_ids(since)
+        for i in range(0, len(paper_ids), self.config.PROCESSING_BATCH_SIZE):
+            locations = Location.objects(body=self.body, paper__in=paper_ids[i:i + self.config.PROCESSING_BATCH_SIZE]).only('id').no_cache()
+            location_ids.update([location.id for location in locations])
+        return list(location_ids)
+
+    def get_objects_by_ids(self, object, ids):
+        for i in range(0, len(ids), self.config.PROCESSING_BATCH_SIZE):
+            for document in object.objects(id__in=ids[i:i + self.config.PROCESSING_BATCH_SIZE]).no_cache():
+                yield document
+
+    def get_region_ids(self):
+        regions = []
+        region = self.body.region
+        while (region):
+            regions.append(str(region.id))
+            region = region.parent
+        return regions
+
+    def bulk_index(self, index_name, actions, count=0):
+        """
+        Sends the actions with the bulk helpers in chunks of ES_BULK_CHUNK_SIZE documents / ES_BULK_MAX_BYTES,
+        with ES_BULK_THREADS parallel requests. The refresh of index_name is disabled while more than
+        ES_BULK_REFRESH_THRESHOLD documents are imported. Returns the counts by result.
+        """
+        statistics = {
+            'created': 0,
+            'updated': 0,
+            'deleted': 0,
+            'failed': 0
+        }
+        refresh_interval = False
+        if count > self.config.ES_BULK_REFRESH_THRESHOLD:
+            refresh_interval = self.disable_refresh(index_name)
+        try:
+            for ok, item in self.bulk(actions):
+                op_type, result = item.popitem()
+                if not ok and not (op_type == 'delete' and result.get('status') == 404):
+                    statistics['failed'] += 1
+                    self.datalog.warn('ElasticSearch %s of %s %s failed: %s' % (
+                        op_type, result.get('_type'), result.get('_id'), result.get('error', result.get('status'))))
+                elif result.get('result') in statistics:
+                    statistics[result['result']] += 1
+        finally:
+            if refresh_interval is not False:
+                self.restore_refresh(index_name, refresh_interval)
+        return statistics
+
+    def bulk(self, actions):
+        kwargs = {
+            'chunk_size': self.config.ES_BULK_CHUNK_SIZE,
+            'max_chunk_bytes': self.config.ES_BULK_MAX_BYTES,
+            'raise_on_error': False,
+            'raise_on_exception': False
+        }
+        if self.config.ES_BULK_THREADS > 1:
+            return helpers.parallel_bulk(self.es, actions, thread_count=self.config.ES_BULK_THREADS, **kwargs)
+        return helpers.streaming_bulk(self.es, actions, **kwargs)
+
+    def disable_refresh(self, index_name):
+        """
+        Turns the refresh of index_name off and returns the old refresh_interval, None if it was the default.
+        Returns False if the refresh is off already, e.g. by a parallel import, which turns it on again.
+        """
+        settings = self.es.indices.get_settings(index=index_name, name='index.refresh_interval')
+        refresh_interval = settings.get(index_name, {}).get('settings', {}).get('index', {}).get('refresh_interval')
+        if refresh_interval == '-1':
+            return False
+        self.es.indices.put_settings(index=index_name, body={'index': {'refresh_interval': '-1'}})
+        return refresh_interval
+
+    def restore_refresh(self, index_name, refresh_interval):
+        self.es.indices.put_settings(index=index_name, body={'index': {'refresh_interval': refresh_interval}})
 
     def es_mapping_generator(self, base_object, deref=None, nested=False, delete=None):
         mapping = {}
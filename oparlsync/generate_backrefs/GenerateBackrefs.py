@@ -10,6 +10,8 @@ Redistribution and use in source and binary forms, with or without modification,
 THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+from mongoengine import ListField
+from pymongo import UpdateOne
 from ..models import *
 from ..base_task import BaseTask
 
@@ -30,6 +32,14 @@ class GenerateBackrefs(BaseTask):
             return
         self.backrefs_created = 0
 
+        # just objects modified since the sync before the last run are new. 'full' rebuilds everything.
+        sync_time = self.body.lastSync
+        self.modified_since = None
+        if 'full' not in args:
+            self.modified_since = self.get_watermark(self.body, 'backrefs')
+        if self.modified_since:
+            self.datalog.info('Generate backreferences for objects modified since %s' % self.modified_since)
+
         # Organization
         #self.backref_item(Membership, 'organization', 'membership')
         self.backref_list_single(Organization, 'membership', 'organization')
@@ -39,7 +49,6 @@ class GenerateBackrefs(BaseTask):
         self.backref_item(Meeting, 'resultsProtocol', 'meeting')
         self.backref_item(Meeting, 'verbatimProtocol', 'meeting')
         self.backref_list(Meeting, 'auxiliaryFile', 'meeting')
-        self.backref_list(Meeting, 'auxiliaryFile', 'meeting')
 
         self.backref_item(AgendaItem, 'resolutionFile', 'agendaItem')
         self.backref_list(AgendaItem, 'auxiliaryFile', 'agendaItem')
@@ -56,38 +65,63 @@ class GenerateBackrefs(BaseTask):
         self.backref_item(Meeting, 'location', 'meeting')
         self.backref_list(Paper, 'location', 'paper')
 
+        if sync_time:
+            self.set_watermark(self.body, 'backrefs', sync_time)
         self.datalog.info('Created %s backreferences' % self.backrefs_created)
 
     def backref_single(self, obj_name, attr, backref_attr):
-        filter = {'body': self.body, attr + '__exists': True}
-        for obj in obj_name.objects(**filter).no_cache().all():
-            if obj != getattr(getattr(obj, attr), backref_attr):
-                setattr(getattr(obj, attr), backref_attr, obj)
-                getattr(obj, attr).save()
-                self.backrefs_created += 1
+        self.backref(obj_name, attr, backref_attr, False, False)
 
     def backref_item(self, obj_name, attr, backref_attr):
-        filter = {'body': self.body, attr + '__exists': True}
-        for obj in obj_name.objects(**filter).no_cache().all():
-            if obj not in getattr(getattr(obj, attr), backref_attr):
-                getattr(getattr(obj, attr), backref_attr).append(obj)
-                getattr(obj, attr).save()
-                self.backrefs_created += 1
+        self.backref(obj_name, attr, backref_attr, False, True)
 
     def backref_list(self, obj_name, attr, backref_attr):
-        filter = {'body': self.body, attr + '__exists': True}
-        for obj in obj_name.objects(**filter).no_cache().all():
-            for sub_obj in getattr(obj, attr):
-                if obj not in getattr(sub_obj, backref_attr):
-                    getattr(sub_obj, backref_attr).append(obj)
-                    sub_obj.save()
-                    self.backrefs_created += 1
+        self.backref(obj_name, attr, backref_attr, True, True)
 
     def backref_list_single(self, obj_name, attr, backref_attr):
-        filter = {'body': self.body, attr + '__exists': True}
-        for obj in obj_name.objects(**filter).no_cache().all():
-            for sub_obj in getattr(obj, attr):
-                if obj != getattr(sub_obj, backref_attr):
-                    setattr(sub_obj, backref_attr, obj)
-                    sub_obj.save()
-                    self.backrefs_created += 1
+        self.backref(obj_name, attr, backref_attr, True, False)
+
+    def backref(self, obj_name, attr, backref_attr, attr_is_list, backref_is_list):
+        """
+        Scans just the ids and references of the source objects and writes the
+        back references as bulk $addToSet / $set, without loading or saving
+        whole documents.
+        """
+        target_collection = self.db_raw[self.get_reference_type(obj_name, attr)._get_collection_name()]
+        operator = '$addToSet' if backref_is_list else '$set'
+        operations = []
+        query = {'body': self.body.id, attr: {'$exists': True}}
+        if self.modified_since:
+            query['$or'] = [
+                {'modified': {'$gte': self.modified_since}},
+                {'modified': {'$exists': False}}
+            ]
+        sources = self.db_raw[obj_name._get_collection_name()].find(
+            query,
+            {attr: 1},
+            no_cursor_timeout=True
+        )
+        try:
+            for source in sources:
+                for target_id in (source[attr] or []) if attr_is_list else [source[attr]]:
+                    if target_id is None:
+                        continue
+                    operations.append(UpdateOne({'_id': target_id}, {operator: {backref_attr: source['_id']}}))
+                    if len(operations) >= self.config.PROCESSING_BATCH_SIZE:
+                        self.save_backrefs(target_collection, operations)
+                        operations = []
+        finally:
+            sources.close()
+        self.save_backrefs(target_collection, operations)
+
+    def get_reference_type(self, obj_name, attr):
+        field = obj_name._fields[attr]
+        if isinstance(field, ListField):
+            field = field.field
+        return field.document_type
+
+    def save_backrefs(self, collection, operations):
+        if not len(operations):
+            return
+        result = collection.bulk_write(operations, ordered=False)
+        self.backrefs_created += result.modified_count
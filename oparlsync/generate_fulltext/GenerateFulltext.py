@@ -11,8 +11,12 @@ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
 """
 
 import os
+import time
 import datetime
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import UpdateOne
 from ..models import *
 from ..base_task import BaseTask
 from minio.error import ResponseError, NoSuchKey
@@ -33,8 +37,16 @@ class GenerateFulltext(BaseTask):
             'wrong-mimetype': 0,
             'file-missing': 0,
             'no-text': 0,
-            'successful': 0
+            'successful': 0,
+            'duplicate': 0
         }
+        # seconds spent per stage, summed over all threads
+        self.timing = {
+            'download': 0,
+            'extraction': 0,
+            'mongodb': 0
+        }
+        self.statistics_lock = threading.Lock()
 
     def run(self, body_id, *args):
         if not self.config.ENABLE_PROCESSING:
@@ -42,46 +54,132 @@ class GenerateFulltext(BaseTask):
         self.body = Body.objects(uid=body_id).no_cache().first()
         if not self.body:
             return
+        start_time = time.time()
+
+        # files without text are processed in batches ordered by id. the watermark is the last id done,
+        # so an interrupted run resumes there. it is reset when a pass is complete, so files which got a
+        # new binary and lost their textStatus are found by the next run.
+        # download and extraction run in a thread pool, the results of a batch are written while the
+        # next batch is processed.
+        watermark = self.get_watermark(self.body, 'fulltext')
+        with ThreadPoolExecutor(max_workers=self.config.THREADS_LOCAL_MAX) as executor:
+            pending = None
+            while True:
+                query = {
+                    'body': self.body.id,
+                    'textStatus__exists': False
+                }
+                if watermark:
+                    query['id__gt'] = watermark
+                query_start_time = time.time()
+                files = list(File.objects(**query).order_by('id').limit(self.config.PROCESSING_BATCH_SIZE).no_cache())
+                self.add_time('mongodb', query_start_time)
+                futures = [executor.submit(self.process_file, file) for file in files]
+                if pending:
+                    self.save_results(*pending)
+                if not len(files):
+                    break
+                watermark = files[-1].id
+                pending = (futures, watermark)
+        self.set_watermark(self.body, 'fulltext', None)
+
+        self.datalog.info('Body %s fulltext done. Results:' % body_id)
+        for key, value in self.statistics.items():
+            self.datalog.info('%s %s' % ((key + ':').ljust(22), value))
+        self.datalog.info('threads:               %s' % self.config.THREADS_LOCAL_MAX)
+        self.datalog.info('download time:         %s s' % round(self.timing['download'], 1))
+        self.datalog.info('extraction time:       %s s' % round(self.timing['extraction'], 1))
+        self.datalog.info('mongodb time:          %s s' % round(self.timing['mongodb'], 1))
+        self.datalog.info('all time:              %s s' % round(time.time() - start_time, 1))
+
+    def save_results(self, futures, watermark):
+        operations = []
+        for future in futures:
+            file_id, update = future.result()
+            operations.append(UpdateOne({'_id': file_id}, {'$set': update}))
+        start_time = time.time()
+        if len(operations):
+            self.db_raw[File._object_db_name].bulk_write(operations, ordered=False)
+        self.set_watermark(self.body, 'fulltext', watermark)
+        self.add_time('mongodb', start_time)
 
-        files = File.objects(textStatus__exists=False, body=self.body.id).timeout(False).no_cache().all()
-        for file in files:
-            self.datalog.info('processing file %s' % file.id)
-            file.modified = datetime.datetime.now()
-            file.textGenerated = datetime.datetime.now()
-            # get file
+    def add_time(self, stage, start_time):
+        with self.statistics_lock:
+            self.timing[stage] += time.time() - start_time
+
+    def count(self, key):
+        with self.statistics_lock:
+            self.statistics[key] += 1
+
+    def process_file(self, file):
+        """
+        Extracts the text of file and returns the fields to update.
+        """
+        self.datalog.info('processing file %s' % file.id)
+        update = {
+            'modified': datetime.datetime.now(),
+            'textGenerated': datetime.datetime.now()
+        }
+        # reuse the text of an identical binary
+        start_time = time.time()
+        duplicate = self.get_duplicate_file(file, 'textStatus', ['successful', 'no-text', 'bad-mimetype'])
+        self.add_time('mongodb', start_time)
+        if duplicate:
+            self.count('duplicate')
+            update['textStatus'] = duplicate.textStatus
+            if duplicate.text:
+                update['text'] = duplicate.text
+            return file.id, update
+
+        # decide app based on mimetype
+        if file.mimeType not in ['application/pdf', 'application/msword']:
+            self.count('wrong-mimetype')
+            update['textStatus'] = 'bad-mimetype'
+            return file.id, update
+
+        # get file
+        start_time = time.time()
+        if self.config.PROCESSING_IN_MEMORY:
+            buffer = self.get_file_buffer(file)
+            file_found = bool(buffer)
+            if buffer:
+                file_path = self.get_buffer_path(buffer)
+                pass_fds = (buffer.fileno(),)
+        else:
+            buffer = None
             file_path = os.path.join(self.config.TMP_FULLTEXT_DIR, str(file.id))
-            if not self.get_file(file, file_path):
-                self.datalog.warn('file not found: %s' % file.id)
-                self.statistics['file-missing'] += 1
-                file.textStatus = 'file-missing'
-                file.save()
-                continue
-
-            # decide app based on mimetype
-            if file.mimeType == 'application/pdf':
-                cmd = '%s -nopgbrk -enc UTF-8 %s -' % (self.config.PDFTOTEXT_COMMAND, file_path)
-            elif file.mimeType == 'application/msword':
-                cmd = '%s --to=txt --to-name=fd://1 %s' % (self.config.ABIWORD_COMMAND, file_path)
-            else:
-                cmd = None
-                self.statistics['wrong-mimetype'] += 1
-                file.textStatus = 'bad-mimetype'
-                file.save()
-                os.unlink(file_path)
-                continue
+            file_found = self.get_file(file, file_path)
+            pass_fds = ()
+        self.add_time('download', start_time)
+        if not file_found:
+            self.datalog.warn('file not found: %s' % file.id)
+            self.count('file-missing')
+            update['textStatus'] = 'file-missing'
+            return file.id, update
 
-            text = self.execute(cmd, self.body.id)
-            if text:
-                text = text.decode().strip().replace(u"\u00a0", " ")
+        if file.mimeType == 'application/pdf':
+            cmd = '%s -nopgbrk -enc UTF-8 %s -' % (self.config.PDFTOTEXT_COMMAND, file_path)
+        else:
+            cmd = '%s --to=txt --to-name=fd://1 %s' % (self.config.ABIWORD_COMMAND, file_path)
 
-            if not text:
-                self.statistics['no-text'] += 1
-                file.textStatus = 'no-text'
-                file.save()
+        start_time = time.time()
+        try:
+            text = self.execute_text(cmd, self.body.id, pass_fds)
+        finally:
+            if buffer:
+                buffer.close()
             else:
-                self.statistics['successful'] += 1
-                file.text = text
-                file.textStatus = 'successful'
-                file.save()
+                os.unlink(file_path)
+        self.add_time('extraction', start_time)
+        if text:
+            text = text.strip().replace(u"\u00a0", " ")
+
+        if not text:
+            self.count('no-text')
+            update['textStatus'] = 'no-text'
+        else:
+            self.count('successful')
+            update['text'] = text
+            update['textStatus'] = 'successful'
 
-            os.unlink(file_path)
+        return file.id, update
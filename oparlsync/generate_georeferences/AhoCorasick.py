@@ -0,0 +1,98 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from collections import deque
+
+
+class AhoCorasick():
+    """
+    Aho-Corasick automaton to find many keys in a text in a single pass. Keys
+    only match at word boundaries and case insensitive, and overlapping matches
+    are resolved to the leftmost longest one, so "Example Street 38" wins over
+    "Example Street 3" and "Example Street".
+    """
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        self.values = {}
+
+    def add(self, key, value):
+        """
+        Adds a key. If a key is added twice, the first value is kept.
+        """
+        key = key.lower()
+        if not key or key in self.values:
+            return
+        self.values[key] = value
+        state = 0
+        for char in key:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.output[state].append(key)
+
+    def build(self):
+        """
+        Computes the failure links. Has to be called after the last add().
+        """
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def __len__(self):
+        return len(self.values)
+
+    def iter(self, text):
+        """
+        Yields (start, end, key, value) for every occurrence of every key, at
+        word boundaries only. Keys and positions refer to the lowercased text.
+        """
+        text = text.lower()
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for key in self.output[state]:
+                start = position - len(key) + 1
+                end = position + 1
+                if start > 0 and text[start - 1].isalnum():
+                    continue
+                if end < len(text) and text[end].isalnum():
+                    continue
+                yield start, end, key, self.values[key]
+
+    def find(self, text):
+        """
+        Returns the non overlapping leftmost longest matches as (key, value).
+        """
+        matches = sorted(self.iter(text), key=lambda match: (match[0], match[0] - match[1]))
+        result = []
+        last_end = 0
+        for start, end, key, value in matches:
+            if start < last_end:
+                continue
+            result.append((key, value))
+            last_end = end
+        return result
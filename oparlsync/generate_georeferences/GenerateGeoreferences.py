@@ -13,7 +13,9 @@ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
 import re
 import geojson
 import datetime
+from pymongo import UpdateOne
 from ..base_task import BaseTask
+from .AhoCorasick import AhoCorasick
 from ..models import Street, Body, File, Location, StreetNumber, LocationOrigin, Paper
 
 
@@ -84,116 +86,174 @@ class GenerateGeoreferences(BaseTask):
                 location.save()
 
     def assign_locations_to_street_numbers(self):
-        for location in Location.objects(body=self.body).timeout(False).no_cache().all():
+        address_index = None
+        location_operations = []
+        street_number_operations = []
+        for location in Location.objects(body=self.body).only('id', 'streetAddress', 'street', 'streetNumber').timeout(False).no_cache().all():
             if location.streetAddress and not (location.street or location.streetNumber):
                 street_name_str, street_number_str = self.get_address_parts(location.streetAddress)
                 if not street_name_str or not street_number_str:
                     continue
-                street_number = StreetNumber.objects(streetName__iexact=street_name_str, streetNumber__iexact=street_number_str, region=self.body.region).no_cache().first()
+                if address_index is None:
+                    address_index = self.get_address_index()
+                street_name_key = self.normalize_address(street_name_str)
+                street_number = address_index.get((street_name_key, self.normalize_address(street_number_str)))
                 if not street_number:
                     street_number_check = self.street_number_regexp.match(street_number_str)
                     if street_number_check.group(2):
-                        street_number = StreetNumber.objects(streetName__iexact=street_name_str, streetNumber__iexact=street_number_check.group(1)).no_cache().first()
-                        if not street_number:
-                            print('%s %s not found' % (street_name_str, street_number_str))
-                            continue
-                    else:
-                        print('%s %s not found' % (street_name_str, street_number_str))
-                        continue
+                        street_number = address_index.get((street_name_key, street_number_check.group(1)))
+                if not street_number:
+                    print('%s %s not found' % (street_name_str, street_number_str))
+                    continue
 
-                location.type = 'address'
-                location.streetName = street_number.streetName
+                update = {
+                    'locationType': 'address',
+                    'geojson': street_number.geojson,
+                    'streetNumber': street_number.id,
+                    'modified': datetime.datetime.now()
+                }
                 if street_number.postalCode:
-                    location.postalCode = street_number.postalCode
+                    update['postalCode'] = street_number.postalCode
                 if street_number.subLocality:
-                    location.subLocality = street_number.subLocality
+                    update['subLocality'] = street_number.subLocality[0]
                 if street_number.locality:
-                    location.locality = street_number.locality
-                location.geojson = street_number.geojson
-                location.streetNumber = street_number
-                location.save()
-                street_number.location = location
-                street_number.save()
+                    update['locality'] = street_number.locality
+                location_operations.append(UpdateOne({'_id': location.id}, {'$set': update}))
+                street_number_operations.append(UpdateOne({'_id': street_number.id}, {'$set': {'location': location.id}}))
+                if len(location_operations) >= self.config.PROCESSING_BATCH_SIZE:
+                    self.save_street_number_locations(location_operations, street_number_operations)
+                    location_operations = []
+                    street_number_operations = []
+        self.save_street_number_locations(location_operations, street_number_operations)
+
+    def get_address_index(self):
+        """
+        Loads all StreetNumbers of the region into a dict keyed by normalized
+        (street name, street number), instead of case insensitive queries per
+        Location which can't use an index.
+        """
+        address_index = {}
+        street_numbers = StreetNumber.objects(region=self.body.region)\
+            .only('id', 'streetName', 'streetNumber', 'postalCode', 'subLocality', 'locality', 'geojson')\
+            .no_cache().timeout(False)
+        for street_number in street_numbers:
+            if not street_number.streetName or not street_number.streetNumber:
+                continue
+            key = (self.normalize_address(street_number.streetName), self.normalize_address(street_number.streetNumber))
+            if key not in address_index:
+                address_index[key] = street_number
+        return address_index
+
+    def save_street_number_locations(self, location_operations, street_number_operations):
+        if len(location_operations):
+            self.db_raw[Location._get_collection_name()].bulk_write(location_operations, ordered=False)
+        if len(street_number_operations):
+            self.db_raw[StreetNumber._get_collection_name()].bulk_write(street_number_operations, ordered=False)
 
     def check_for_streets(self):
-        streets = Street.objects(region=self.body.region).no_cache().timeout(False).all()
-        for street in streets:
-            # todo: use ES index to have aliases like str. -> strasse
-            files = File.objects(body=self.body, georeferencesGenerated__exists=False).search_text('"' + street.streetName + '"').no_cache().timeout(False).all()
-            for file in files:
-                locations = []
-                text = []
-                if file.name:
-                    text.append(file.name)
-                if file.text:
-                    text.append(file.text)
-                if len(text):
-                    text = ' '.join(text)
-                    if street.streetName in text:
-                        locations = self.check_for_street_numbers(street, text, file.id)
-                # use whole street
-                if not len(locations):
-                    self.datalog.debug('Street %s found in File %s' % (street.streetName, file.id))
-                    locations.append(self.create_location(
-                        'street',
-                        street.streetName,
-                        None,
-                        street.postalCode,
-                        street.subLocality,
-                        street.locality,
-                        street.geojson,
-                        streetObj=street
-                    ))
-                for paper in file.paper:
-                    for location in locations:
-                        save_paper = False
-                        if location not in paper.location:
-                            paper.location.append(location)
+        matcher = self.get_street_matcher()
+        if not len(matcher):
+            return
+        files = File.objects(body=self.body, textStatus__exists=True, georeferencesGenerated__exists=False)\
+            .only('id', 'name', 'text', 'paper').no_cache().timeout(False)
+        for file in files:
+            text = []
+            if file.name:
+                text.append(file.name)
+            if file.text:
+                text.append(file.text)
+            # without any text there is nothing to scan yet, so the file stays open for the next run
+            if not len(text):
+                continue
+            locations = self.check_for_locations(matcher, ' '.join(text), file.id)
+            for paper in file.paper:
+                for location in locations:
+                    save_paper = False
+                    if location not in paper.location:
+                        paper.location.append(location)
+                        save_paper = True
+                    if paper not in location.paper:
+                        location.paper.append(paper)
+                        location.save()
+                    if not LocationOrigin.objects(paper=paper.id, location=location.id, origin='auto').no_cache().count():
+                        location_origin = LocationOrigin()
+                        location_origin.location = location.id
+                        location_origin.paper = paper.id
+                        location_origin.origin = 'auto'
+                        location_origin.save()
+                        if location_origin.id not in paper.locationOrigin:
+                            paper.locationOrigin.append(location_origin.id)
                             save_paper = True
-                        if paper not in location.paper:
-                            location.paper.append(paper)
-                            location.save()
-                        if not LocationOrigin.objects(paper=paper.id, location=location.id, origin='auto').no_cache().count():
-                            location_origin = LocationOrigin()
-                            location_origin.location = location.id
-                            location_origin.paper = paper.id
-                            location_origin.origin = 'auto'
-                            location_origin.save()
-                            if location_origin.id not in paper.locationOrigin:
-                                paper.locationOrigin.append(location_origin.id)
-                                save_paper = True
-                        if save_paper:
-                            paper.save()
+                    if save_paper:
+                        paper.save()
 
-                file.georeferencesStatus = 'generated'
-                file.georeferencesGenerated = datetime.datetime.now()
-                file.save()
+            File.objects(id=file.id).update_one(
+                set__georeferencesStatus='generated',
+                set__georeferencesGenerated=datetime.datetime.now()
+            )
 
-    def check_for_street_numbers(self, street, text, file_id):
+    def get_street_matcher(self):
+        """
+        Builds one automaton from all street names and "name number" addresses
+        of the region, so every file text is scanned just once.
+        """
+        matcher = AhoCorasick()
+        for street_number in StreetNumber.objects(region=self.body.region).only('id', 'streetName', 'streetNumber').no_cache().timeout(False):
+            if street_number.streetName and street_number.streetNumber:
+                matcher.add(street_number.streetName + ' ' + street_number.streetNumber, ('address', street_number.id))
+        for street in Street.objects(region=self.body.region).only('id', 'streetName').no_cache().timeout(False):
+            if street.streetName:
+                matcher.add(street.streetName, ('street', street.id))
+        matcher.build()
+        return matcher
+
+    def check_for_locations(self, matcher, text, file_id):
         locations = []
-        if street.streetNumber:
-            for street_number in street.streetNumber:
-                if street_number.streetName + ' ' + street_number.streetNumber in text:
-                    do_save = True
-                    # check: is there another street number like examplestreet 38 if this is examplestreet 3? then proceed
-                    # todo: make it even better detecting examplestreet 3 AND 38
-                    for street_number_check in street.streetNumber:
-                        if street_number.streetName + ' ' + street_number.streetNumber in street_number_check.streetName + ' ' + street_number_check.streetNumber and len(street_number.streetNumber) < len(street_number_check.streetNumber):
-                            if street_number_check.streetName + ' ' + street_number_check.streetNumber in text:
-                                do_save = False
-                                continue
-                    if not do_save:
-                        continue
-                    self.datalog.debug('Adresse %s %s found in File %s' % (street_number.streetName, street_number.streetNumber, file_id))
-                    locations.append(self.create_location(
-                        'address',
-                        street_number.streetName,
-                        street_number.streetNumber,
-                        street_number.postalCode,
-                        street_number.subLocality,
-                        street_number.locality,
-                        street_number.geojson
-                    ))
+        addresses = set()
+        street_number_ids = []
+        streets = []
+        # longest match wins, so examplestreet 38 is not found as examplestreet 3 or examplestreet
+        for key, (type, id) in matcher.find(text):
+            if type == 'address':
+                if id not in street_number_ids:
+                    street_number_ids.append(id)
+            elif id not in streets:
+                streets.append(id)
+        if len(street_number_ids):
+            street_numbers = dict([
+                (street_number.id, street_number)
+                for street_number in StreetNumber.objects(id__in=street_number_ids).no_cache()
+            ])
+            for id in street_number_ids:
+                street_number = street_numbers.get(id)
+                if not street_number:
+                    continue
+                addresses.add(street_number.streetName)
+                self.datalog.debug('Adresse %s %s found in File %s' % (street_number.streetName, street_number.streetNumber, file_id))
+                locations.append(self.create_location(
+                    'address',
+                    street_number.streetName,
+                    street_number.streetNumber,
+                    street_number.postalCode,
+                    street_number.subLocality,
+                    street_number.locality,
+                    street_number.geojson
+                ))
+        # use whole street if there is no address of it
+        for street in Street.objects(id__in=streets).no_cache():
+            if street.streetName in addresses:
+                continue
+            self.datalog.debug('Street %s found in File %s' % (street.streetName, file_id))
+            locations.append(self.create_location(
+                'street',
+                street.streetName,
+                None,
+                street.postalCode,
+                street.subLocality,
+                street.locality,
+                street.geojson,
+                streetObj=street
+            ))
         return locations
 
     def create_location(self, type, streetName, streetNumber, postalCode, subLocality, locality, geojson, streetObj=None, streetNumberObj=None):
@@ -274,6 +334,14 @@ class GenerateGeoreferences(BaseTask):
         return False, False
 
 
+    def normalize_address(self, text):
+        """
+        Casefolded address part with str. and strasse written the same way.
+        Casefolding turns ß into ss, so straße ends up as strasse too.
+        """
+        text = text.casefold().replace('str.', 'strasse')
+        return ' '.join(text.split())
+
     def fix_address_text(self, text):
         text = text.replace('str.', 'straße')
         text = text.replace('strasse', 'straße')
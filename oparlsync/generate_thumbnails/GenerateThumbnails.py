@@ -11,9 +11,15 @@ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
 """
 
 import os
+import re
+import sys
+import time
 import shutil
 import datetime
+import numpy
+import threading
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor, wait
 from ..base_task import BaseTask
 from ..models import Body, File
 from minio.error import ResponseError, NoSuchKey
@@ -32,146 +38,434 @@ class GenerateThumbnails(BaseTask):
         self.statistics = {
             'wrong-mimetype': 0,
             'file-missing': 0,
-            'successful': 0
+            'successful': 0,
+            'duplicate': 0,
+            'upload-count': 0,
+            'upload-failed': 0,
+            'upload-failed-files': 0,
+            'upload-bytes': 0,
+            'failed': 0
         }
+        self.upload_time = 0
+        self.statistics_lock = threading.Lock()
 
     def run(self, body_id, *args):
+        if len(args) and args[0] == 'benchmark':
+            self.benchmark(args[1:])
+            return
         if not self.config.ENABLE_PROCESSING:
             return
         self.body = Body.objects(uid=body_id).no_cache().first()
         if not self.body:
             return
-        files = File.objects(thumbnailStatus__exists=False, body=self.body.id).no_cache().all()
-        while True:
-            try:
-                file = next(files)
-            except CursorNotFound:
-                files = File.objects(thumbnailStatus__exists=False, body=self.body.id).no_cache().all()
-                file = next(files)
-                continue
-            except StopIteration:
-                break
-            if not file:
-                break
-            self.datalog.info('processing file %s' % file.id)
-            file.modified = datetime.datetime.now()
-            file.thumbnailGenerated = datetime.datetime.now()
+        start_time = time.time()
+        # page ranges of a document are rendered in parallel, images are uploaded as soon as they are written
+        self.executor = ThreadPoolExecutor(max_workers=self.config.THREADS_LOCAL_MAX)
+        self.upload_executor = ThreadPoolExecutor(max_workers=self.config.THUMBNAIL_UPLOAD_THREADS)
+        try:
+            files = File.objects(thumbnailStatus__exists=False, body=self.body.id).no_cache().all()
+            while True:
+                try:
+                    file = next(files)
+                except CursorNotFound:
+                    files = File.objects(thumbnailStatus__exists=False, body=self.body.id).no_cache().all()
+                    file = next(files)
+                    continue
+                except StopIteration:
+                    break
+                if not file:
+                    break
+                try:
+                    self.process_file(file)
+                except Exception as err:
+                    # one broken document must not stop the body, the file is tried again next run
+                    self.datalog.error('Critical error generating thumbnails from File %s from Body %s: %s' % (file.id, self.body.id, err))
+                    self.statistics['failed'] += 1
+        finally:
+            self.executor.shutdown()
+            self.upload_executor.shutdown()
 
-            # get file
-            file_path =  os.path.join(self.config.TMP_THUMBNAIL_DIR, str(file.id))
-            if not self.get_file(file, file_path):
-                self.datalog.warn('file not found: %s' % file.id)
-                self.statistics['file-missing'] += 1
-                file.thumbnailStatus = 'file-missing'
-                file.thumbnailsGenerated = datetime.datetime.now()
-                file.modified = datetime.datetime.now()
-                file.save()
-                continue
+        self.datalog.info('Body %s thumbnails done. Results:' % body_id)
+        for key, value in self.statistics.items():
+            self.datalog.info('%s %s' % ((key + ':').ljust(22), value))
+        megabytes = self.statistics['upload-bytes'] / 1024 / 1024
+        self.datalog.info('upload time:           %s s in %s threads (%s MB/s per thread)' % (
+            round(self.upload_time, 1),
+            self.config.THUMBNAIL_UPLOAD_THREADS,
+            round(megabytes / self.upload_time, 2) if self.upload_time else 0
+        ))
+        self.datalog.info('all time:              %s s' % round(time.time() - start_time, 1))
 
-            if file.mimeType not in ['application/msword', 'application/pdf']:
-                self.datalog.warn('wrong mimetype: %s' % file.id)
-                self.statistics['wrong-mimetype'] += 1
-                file.thumbnailStatus = 'wrong-mimetype'
-                file.thumbnailsGenerated = datetime.datetime.now()
-                file.modified = datetime.datetime.now()
-                file.save()
-                os.unlink(file_path)
-                continue
+    def process_file(self, file):
+        self.datalog.info('processing file %s' % file.id)
+        file.modified = datetime.datetime.now()
+        file.thumbnailGenerated = datetime.datetime.now()
+
+        # reuse the thumbnails of an identical binary
+        duplicate = self.get_rendered_duplicate(file)
+        if duplicate and self.copy_thumbnails(duplicate, file):
+            self.statistics['duplicate'] += 1
+            return
 
-            file_path_old = False
+        # get file. in memory mode paths point to /dev/fd/N of the buffers and must never be unlinked
+        buffers = []
+        in_memory = self.config.PROCESSING_IN_MEMORY
+        if in_memory:
+            buffer = self.get_file_buffer(file)
+            if buffer:
+                buffers.append(buffer)
+                file_path = self.get_buffer_path(buffer)
+            file_found = bool(buffer)
+        else:
+            file_path = os.path.join(self.config.TMP_THUMBNAIL_DIR, str(file.id))
+            file_found = self.get_file(file, file_path)
+        if not file_found:
+            self.datalog.warn('file not found: %s' % file.id)
+            self.statistics['file-missing'] += 1
+            file.thumbnailStatus = 'file-missing'
+            file.thumbnailGenerated = datetime.datetime.now()
+            file.modified = datetime.datetime.now()
+            file.save()
+            return
+
+        if file.mimeType not in ['application/msword', 'application/pdf']:
+            self.datalog.warn('wrong mimetype: %s' % file.id)
+            self.statistics['wrong-mimetype'] += 1
+            file.thumbnailStatus = 'wrong-mimetype'
+            file.thumbnailGenerated = datetime.datetime.now()
+            file.modified = datetime.datetime.now()
+            file.save()
+            self.remove_input(file_path, buffers, in_memory)
+            return
+
+        file_path_old = False
+        max_folder = os.path.join(self.config.TMP_THUMBNAIL_DIR, str(file.id) + '-max')
+        out_folder = os.path.join(self.config.TMP_THUMBNAIL_DIR, str(file.id) + '-out')
+        uploads = []
+        try:
             if file.mimeType == 'application/msword':
                 file_path_old = file_path
-                file_path = file_path + '-old'
+                if in_memory:
+                    buffers.append(self.create_buffer(str(file.id) + '-pdf'))
+                    file_path = self.get_buffer_path(buffers[-1])
+                else:
+                    file_path = file_path + '-old'
                 cmd = ('%s --to=PDF -o %s %s' % (self.config.ABIWORD_COMMAND, file_path, file_path_old))
-                self.execute(cmd, self.body.id)
+                self.execute(cmd, self.body.id, [buffer.fileno() for buffer in buffers])
+            pass_fds = [buffer.fileno() for buffer in buffers]
 
             # create folders
-            max_folder = os.path.join(self.config.TMP_THUMBNAIL_DIR, str(file.id) + '-max')
             if not os.path.exists(max_folder):
                 os.makedirs(max_folder)
-            out_folder = os.path.join(self.config.TMP_THUMBNAIL_DIR, str(file.id) + '-out')
             if not os.path.exists(out_folder):
                 os.makedirs(out_folder)
             for size in self.config.THUMBNAIL_SIZES:
                 if not os.path.exists(os.path.join(out_folder, str(size))):
                     os.makedirs(os.path.join(out_folder, str(size)))
             file.thumbnail = {}
-            pages = 0
-
-            # generate max images
-            max_path = max_folder + os.sep + '%d.png'
-            cmd = '%s -dQUIET -dSAFER -dBATCH -dNOPAUSE -sDisplayHandle=0 -sDEVICE=png16m -r100 -dTextAlphaBits=4 -sOutputFile=%s -f %s' % (
-            self.config.GHOSTSCRIPT_COMMAND, max_path, file_path)
-            self.execute(cmd, self.body.id)
-
-            # generate thumbnails based on max images
-            for max_file in os.listdir(max_folder):
-                pages += 1
-                file_path_max = os.path.join(max_folder, max_file)
-                num = max_file.split('.')[0]
-                im = Image.open(file_path_max)
-                im = self.conditional_to_greyscale(im)
-                (owidth, oheight) = im.size
-                file.thumbnail[str(num)] = {
-                    'page': int(num),
-                    'pages': {}
-                }
-
-                for size in self.config.THUMBNAIL_SIZES:
-                    (width, height) = self.scale_width_height(size, owidth, oheight)
-                    # Two-way resizing
-                    resizedim = im
-                    if oheight > (height * 2.5):
-                        # generate intermediate image with double size
-                        resizedim = resizedim.resize((width * 2, height * 2), Image.NEAREST)
-                    resizedim = resizedim.resize((width, height), Image.ANTIALIAS)
-                    out_path = os.path.join(out_folder, str(size), str(num) + '.jpg')
-                    resizedim.save(out_path, subsampling=0, quality=80)
-                    # optimize image
-                    cmd = '%s --preserve-perms %s' % (self.config.JPEGOPTIM_PATH, out_path)
-                    self.execute(cmd, self.body.id)
-                    # create mongodb object and append it to file
-                    file.thumbnail[str(num)]['pages'][str(size)] = {
-                        'width': width,
-                        'height': height,
-                        'filesize': os.path.getsize(out_path)
-                    }
-            # save all generated files in minio
-            for size in self.config.THUMBNAIL_SIZES:
-                for out_file in os.listdir(os.path.join(out_folder, str(size))):
-                    try:
-                        self.s3.fput_object(
-                            self.config.S3_BUCKET,
-                            "file-thumbnails/%s/%s/%s/%s" % (self.body.id, str(file.id), str(size), out_file),
-                            os.path.join(out_folder, str(size), out_file),
-                            'image/jpeg'
-                        )
-                    except ResponseError as err:
-                        self.datalog.error(
-                            'Critical error saving file from File %s from Body %s' % (file.id, self.body.id))
-            # save in mongodb
-            file.thumbnailStatus = 'successful'
-            file.thumbnailsGenerated = datetime.datetime.now()
-            file.modified = datetime.datetime.now()
-            file.pages = pages
-            file.save()
-            # tidy up
-            try:
-                os.unlink(file_path)
-            except FileNotFoundError:
-                pass
+
+            # render and resize page ranges in parallel. if the page count is unknown, all at once.
+            page_count = self.get_page_count(file_path, pass_fds)
+            if page_count:
+                page_ranges = [
+                    (first, min(first + self.config.THUMBNAIL_PAGES_PER_JOB - 1, page_count))
+                    for first in range(1, page_count + 1, self.config.THUMBNAIL_PAGES_PER_JOB)
+                ]
+            else:
+                page_ranges = [(None, None)]
+            futures = [
+                self.executor.submit(self.render_pages, file, file_path, pass_fds, max_folder, out_folder, first, last, uploads)
+                for first, last in page_ranges
+            ]
+            # every range has to be done before a failed one may remove the input and the folders
+            wait(futures)
+            for future in futures:
+                file.thumbnail.update(future.result())
+            self.remove_input(file_path, buffers, in_memory)
+            if self.config.THUMBNAIL_PACKED:
+                self.pack_thumbnails(file, out_folder, uploads)
+                file.thumbnailFormat = 'packed'
+            else:
+                file.thumbnailFormat = None
+
+            # all images have to be in minio before the folders are removed
+            if self.wait_for_uploads(file, uploads):
+                # save in mongodb
+                self.statistics['successful'] += 1
+                file.thumbnailStatus = 'successful'
+                file.thumbnailGenerated = datetime.datetime.now()
+                file.modified = datetime.datetime.now()
+                file.pages = len(file.thumbnail)
+                file.save()
+            else:
+                # thumbnailStatus stays unset, so the next run tries again
+                self.datalog.warn('upload failed: %s' % file.id)
+                self.statistics['upload-failed-files'] += 1
+        finally:
+            # tidy up, even if rendering failed
+            wait(uploads)
+            self.remove_input(file_path, buffers, in_memory)
+            if file_path_old and not in_memory:
+                try:
+                    os.unlink(file_path_old)
+                except FileNotFoundError:
+                    pass
+            shutil.rmtree(max_folder, ignore_errors=True)
+            shutil.rmtree(out_folder, ignore_errors=True)
+
+    page_count_regexp = re.compile(r'^Pages:\s+(\d+)', re.MULTILINE)
+
+    def get_page_count(self, file_path, pass_fds):
+        output = self.execute('%s %s' % (self.config.PDFINFO_COMMAND, file_path), self.body.id, pass_fds)
+        if not output:
+            return None
+        match = self.page_count_regexp.search(output.decode(errors='replace'))
+        if not match:
+            return None
+        return int(match.group(1))
+
+    def render_pages(self, file, file_path, pass_fds, max_folder, out_folder, first, last, uploads):
+        """
+        Renders the pages first to last (all if first is None) and generates all thumbnail sizes of them.
+        """
+        range_folder = os.path.join(max_folder, str(first or 1))
+        if not os.path.exists(range_folder):
+            os.makedirs(range_folder)
+        page_range = '' if first is None else '-dFirstPage=%s -dLastPage=%s ' % (first, last)
+        cmd = '%s -dQUIET -dSAFER -dBATCH -dNOPAUSE -sDisplayHandle=0 -sDEVICE=png16m -r100 -dTextAlphaBits=4 %s-sOutputFile=%s -f %s' % (
+            self.config.GHOSTSCRIPT_COMMAND, page_range, os.path.join(range_folder, '%d.png'), file_path)
+        self.execute(cmd, self.body.id, pass_fds)
+
+        thumbnail = {}
+        for max_file in os.listdir(range_folder):
+            # ghostscript starts counting at 1 for every range
+            num = int(max_file.split('.')[0]) + (first or 1) - 1
+            thumbnail[str(num)] = self.generate_page_thumbnails(file, os.path.join(range_folder, max_file), out_folder, num, uploads)
+        return thumbnail
+
+    def generate_page_thumbnails(self, file, file_path_max, out_folder, num, uploads):
+        """
+        Generates all sizes of one page from the same decoded image and queues their upload.
+        """
+        im = Image.open(file_path_max)
+        im = self.conditional_to_greyscale(im)
+        page = {
+            'page': num,
+            'pages': {}
+        }
+        for size, resizedim in self.resize_pyramid(im):
+            (width, height) = resizedim.size
+            out_path = os.path.join(out_folder, str(size), str(num) + '.jpg')
+            # optimize=True does what jpegoptim did before
+            resizedim.save(out_path, subsampling=0, quality=80, optimize=True)
+            page['pages'][str(size)] = {
+                'width': width,
+                'height': height,
+                'filesize': os.path.getsize(out_path)
+            }
+            if not self.config.THUMBNAIL_PACKED:
+                uploads.append(self.upload_executor.submit(
+                    self.upload_thumbnail,
+                    file,
+                    out_path,
+                    "file-thumbnails/%s/%s/%s/%s.jpg" % (self.body.id, str(file.id), str(size), num)
+                ))
+        im.close()
+        return page
+
+    def pack_thumbnails(self, file, out_folder, uploads):
+        """
+        Concatenates all pages of one size to a single object. The offset of every page is stored next
+        to its filesize, so a page can be fetched with a range request.
+        """
+        for size in self.config.THUMBNAIL_SIZES:
+            pack_path = os.path.join(out_folder, '%s.pack' % size)
+            offset = 0
+            with open(pack_path, 'wb') as pack:
+                for num in sorted(file.thumbnail.keys(), key=int):
+                    with open(os.path.join(out_folder, str(size), num + '.jpg'), 'rb') as image:
+                        shutil.copyfileobj(image, pack)
+                    file.thumbnail[num]['pages'][str(size)]['offset'] = offset
+                    offset += file.thumbnail[num]['pages'][str(size)]['filesize']
+            uploads.append(self.upload_executor.submit(
+                self.upload_thumbnail,
+                file,
+                pack_path,
+                "file-thumbnails/%s/%s/%s.pack" % (self.body.id, str(file.id), str(size)),
+                'application/octet-stream'
+            ))
+
+    def get_thumbnail_object_names(self, file):
+        """
+        Returns the names of all thumbnail objects of file relative to its thumbnail folder.
+        """
+        names = []
+        for num, page in file.thumbnail.items():
+            for size in page['pages'].keys():
+                if file.thumbnailFormat == 'packed':
+                    name = '%s.pack' % size
+                else:
+                    name = '%s/%s.jpg' % (size, num)
+                if name not in names:
+                    names.append(name)
+        return names
+
+    def wait_for_uploads(self, file, uploads):
+        """
+        Waits for all uploads of file, returns False if any of them failed.
+        """
+        successful = True
+        for upload in uploads:
             try:
-                if file_path_old:
-                    os.unlink(file_path)
-            except FileNotFoundError:
-                pass
-            shutil.rmtree(max_folder)
-            shutil.rmtree(out_folder)
+                if not upload.result():
+                    successful = False
+            except Exception as err:
+                self.datalog.error('Critical error uploading thumbnails from File %s from Body %s: %s' % (file.id, self.body.id, err))
+                successful = False
+        return successful
+
+    def upload_thumbnail(self, file, file_path, object_name, content_type='image/jpeg'):
+        start_time = time.time()
+        try:
+            self.s3.fput_object(
+                self.config.S3_BUCKET,
+                object_name,
+                file_path,
+                content_type
+            )
+        except ResponseError as err:
+            self.datalog.error(
+                'Critical error saving file from File %s from Body %s' % (file.id, self.body.id))
+            with self.statistics_lock:
+                self.statistics['upload-failed'] += 1
+            return False
+        with self.statistics_lock:
+            self.statistics['upload-count'] += 1
+            self.statistics['upload-bytes'] += os.path.getsize(file_path)
+            self.upload_time += time.time() - start_time
+        return True
+
+    def remove_input(self, file_path, buffers, in_memory):
+        if in_memory:
+            for buffer in buffers:
+                buffer.close()
+            del buffers[:]
+            return
+        try:
+            os.unlink(file_path)
+        except FileNotFoundError:
+            pass
+
+    def get_rendered_duplicate(self, file):
+        """
+        Looks for an already processed File with the same binary: first in the deduplicated store of the
+        body, then by the sha512 checksum computed at download in all bodies. Upstream checksums are not
+        used, as they are not verified.
+        """
+        duplicate = self.get_duplicate_file(file, 'thumbnailStatus', ['successful', 'wrong-mimetype'])
+        if duplicate:
+            return duplicate
+        if not file.downloadedChecksum:
+            return None
+        return File.objects(
+            downloadedChecksum=file.downloadedChecksum,
+            thumbnailStatus='successful',
+            id__ne=file.id
+        ).no_cache().first()
+
+    def copy_thumbnails(self, source, file):
+        """
+        Copies the thumbnails of source to file inside S3 and takes over the metadata.
+        """
+        if source.thumbnailStatus == 'successful':
+            for name in self.get_thumbnail_object_names(source):
+                try:
+                    self.s3.copy_object(
+                        self.config.S3_BUCKET,
+                        "file-thumbnails/%s/%s/%s" % (file.body.id, str(file.id), name),
+                        "/%s/file-thumbnails/%s/%s/%s" % (self.config.S3_BUCKET, source.body.id, str(source.id), name)
+                    )
+                except ResponseError as err:
+                    self.datalog.warn('Critical error copying thumbnails from File %s to File %s' % (source.id, file.id))
+                    return False
+        file.thumbnail = source.thumbnail
+        file.thumbnailFormat = source.thumbnailFormat
+        file.pages = source.pages
+        file.thumbnailStatus = source.thumbnailStatus
+        file.thumbnailGenerated = datetime.datetime.now()
+        file.modified = datetime.datetime.now()
+        file.save()
+        return True
 
     def conditional_to_greyscale(self, image):
+        """
+        Convert the image to greyscale if all pixels have equal
+        color channels
+        """
+        if image.mode not in ['RGB', 'RGBA']:
+            return image
+        pixels = numpy.asarray(image)
+        if numpy.array_equal(pixels[..., 0], pixels[..., 1]) and numpy.array_equal(pixels[..., 1], pixels[..., 2]):
+            return image.convert('L')
+        return image
+
+    def resize_pyramid(self, image):
+        """
+        Yields (size, image) for all THUMBNAIL_SIZES, largest first. Every
+        size is resized from the next larger one instead of the full page.
+        """
+        (owidth, oheight) = image.size
+        source = image
+        for size in sorted(self.config.THUMBNAIL_SIZES, reverse=True):
+            (width, height) = self.scale_width_height(size, owidth, oheight)
+            source = self.resize(source, width, height)
+            yield size, source
+
+    def resize_direct(self, image):
+        """
+        Old resizing: every size from the full page. Just used by the benchmark.
+        """
+        (owidth, oheight) = image.size
+        for size in self.config.THUMBNAIL_SIZES:
+            (width, height) = self.scale_width_height(size, owidth, oheight)
+            yield size, self.resize(image, width, height)
+
+    def resize(self, image, width, height):
+        # Two-way resizing
+        if image.size[1] > (height * 2.5):
+            # generate intermediate image with double size
+            image = image.resize((width * 2, height * 2), Image.NEAREST)
+        return image.resize((width, height), Image.ANTIALIAS)
+
+    def benchmark(self, paths, rounds=5):
+        """
+        Compares the histogram / direct resize path with the numpy / pyramid path on sample page images.
+        """
+        if not len(paths):
+            sys.exit('usage: python manage.py single generate_thumbnails $body benchmark $page.png ...')
+        for path in paths:
+            image = Image.open(path)
+            image.load()
+            results = {}
+            for name, greyscale, resize in [
+                ('histogram + direct', self.conditional_to_greyscale_histogram, self.resize_direct),
+                ('numpy + pyramid', self.conditional_to_greyscale, self.resize_pyramid)
+            ]:
+                start_time = time.time()
+                for i in range(rounds):
+                    converted = greyscale(image)
+                    for size, resized in resize(converted):
+                        pass
+                results[name] = (time.time() - start_time) / rounds
+                self.datalog.info('%s %s: %s ms per page, mode %s' % (
+                    path, name.ljust(18), round(results[name] * 1000, 1), converted.mode))
+            self.datalog.info('%s speedup: %sx' % (
+                path, round(results['histogram + direct'] / results['numpy + pyramid'], 2)))
+
+    def conditional_to_greyscale_histogram(self, image):
         """
         Convert the image to greyscale if the image information
-        is greyscale only
+        is greyscale only. Approximate, just used by the benchmark.
         """
         bands = image.getbands()
         if len(bands) >= 3:
@@ -16,9 +16,7 @@ import json
 import hashlib
 import threading
 from pymongo import MongoClient
-from _datetime import datetime
 from geojson import Feature
-import requests
 import subprocess
 from slugify import slugify
 from ..models import *
@@ -94,6 +92,7 @@ class Maintenance(BaseTask):
         for object in self.valid_objects:
             if object != Body:
                 object.objects(body=body.id).delete()
+        ListPage.objects(body=body.id).delete()
         # delete in minio
         try:
             get_name = lambda object: object.object_name
@@ -170,7 +169,10 @@ class Maintenance(BaseTask):
 
     def generate_region(self, region_data):
         rgs = region_data['rgs']
-        r = requests.get('https://www.openstreetmap.org/api/0.6/relation/%s/full' % region_data['osm_relation'], stream=True)
+        r = self.http_get('https://www.openstreetmap.org/api/0.6/relation/%s/full' % region_data['osm_relation'], stream=True)
+        if not r or r.status_code != 200:
+            self.datalog.error('osm relation %s could not be downloaded' % region_data['osm_relation'])
+            return
         with open(os.path.join(self.config.TMP_OSM_DIR, rgs + '.rel'), 'wb') as f:
             for chunk in r.iter_content(chunk_size=1024):
                 if chunk:
@@ -250,58 +252,8 @@ class Maintenance(BaseTask):
         return regions
 
     def elasticsearch_regions(self):
-        if not self.es.indices.exists_alias(name='region-latest'):
-            now = datetime.utcnow()
-            index_name = 'region-' + now.strftime('%Y%m%d-%H%M')
-
-            es_import = ElasticsearchImport(self)
-
-            mapping = es_import.es_mapping_generator(Region, deref='deref_region', delete='delete_region')
-            mapping['properties']['body_count'] = {
-                'type': 'integer'
-            }
-            self.es.indices.create(index=index_name, body={
-                'settings': es_import.es_settings(),
-                'mappings': {
-                    'region': mapping
-                }
-            })
-
-            self.es.indices.update_aliases({
-                'actions': {
-                    'add': {
-                        'index': index_name,
-                        'alias': 'region-latest'
-                    }
-                }
-            })
-
-        else:
-            index_name = list(self.es.indices.get_alias('region-latest'))[0]
-
-        for region in Region.objects():
-            region_dict = region.to_dict()
-            region_dict['geosearch'] = {
-                'type': 'envelope',
-                'coordinates': region_dict['bounds']
-            }
-            region_dict['geojson']['properties']['legacy'] = region.legacy
-            region_dict['geojson']['properties']['bodies'] = []
-            region_dict['body_count'] = len(region.body)
-            for body in region.body:
-                region_dict['geojson']['properties']['bodies'].append(str(body.id))
-
-            region_dict['geojson'] = json.dumps(region_dict['geojson'])
-            del region_dict['bounds']
-            region_dict['legacy']= bool(region.legacy)
-
-
-            new_doc = self.es.index(
-                index=index_name,
-                id=str(region.id),
-                doc_type='region',
-                body=region_dict
-            )
+        es_import = ElasticsearchImport(self)
+        es_import.region_index()
 
     def update_street_locality(self):
         for street in Street.objects():
@@ -432,9 +384,9 @@ class Maintenance(BaseTask):
             if 'filename' in file_raw:
                 file.fileName = file_raw['filename']
 
-            r = requests.get('https://politik-bei-uns.de/file/%s/download' % file.id, stream=True)
+            r = self.http_get('https://politik-bei-uns.de/file/%s/download' % file.id, stream=True)
 
-            if r.status_code != 200:
+            if not r or r.status_code != 200:
                 file.downloaded = False
             else:
                 file_path = os.path.join(self.config.TMP_OLD_IMPORT_DIR, str(file.id))
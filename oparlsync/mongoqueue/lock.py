@@ -22,7 +22,7 @@ class MongoLock(object):
     def __init__(self, collection, lock_name, lease=120):
         self.collection = collection
         self.lock_name = lock_name
-        self._client_id = uuid.uuid4().get_hex()
+        self._client_id = uuid.uuid4().hex
         self._locked = False
         self._lease_time = lease
         self._lock_expires = False
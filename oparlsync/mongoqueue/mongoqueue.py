@@ -13,8 +13,11 @@
 #   limitations under the License.
 
 
+import time
 import pymongo
 
+from pymongo.cursor import CursorType
+from pymongo.errors import CollectionInvalid, DuplicateKeyError
 from datetime import datetime, timedelta
 import traceback
 
@@ -31,13 +34,62 @@ class MongoQueue(object):
     """A queue class
     """
 
-    def __init__(self, collection, consumer_id, timeout=300, max_attempts=3):
+    def __init__(self, collection, consumer_id, timeout=300, max_attempts=3, signal_size=1024 * 1024):
         """
+        Every put() also writes to a small capped collection, so consumers
+        can block on a tailable cursor in wait() instead of polling.
+        signal_size=None disables this and wait() falls back to polling.
         """
         self.collection = collection
         self.consumer_id = consumer_id
         self.timeout = timeout
         self.max_attempts = max_attempts
+        self.signal_collection = None
+        self._last_signal = None
+        self.ensure_indexes()
+        if signal_size:
+            self.init_signal(signal_size)
+
+    def ensure_indexes(self):
+        """Indexes for next(): equality on the lock, then the sort, then
+        the attempts range.
+        """
+        self.collection.create_index([
+            ("locked_by", pymongo.ASCENDING),
+            ("locked_at", pymongo.ASCENDING),
+            ("priority", pymongo.DESCENDING),
+            ("_id", pymongo.ASCENDING),
+            ("attempts", pymongo.ASCENDING)
+        ], background=True)
+        # at most one waiting job per key, the pending_key is removed while the job is locked
+        self.collection.create_index("pending_key", unique=True, sparse=True, background=True)
+        self.collection.create_index([
+            ("key", pymongo.ASCENDING),
+            ("locked_by", pymongo.ASCENDING)
+        ], background=True)
+
+    def init_signal(self, size):
+        """Create the capped signal collection if necessary.
+        """
+        database = self.collection.database
+        name = "%s_signal" % self.collection.name
+        try:
+            database.create_collection(name, capped=True, size=size)
+        except CollectionInvalid:
+            pass
+        self.signal_collection = database[name]
+        # a tailable cursor on an empty capped collection dies at once
+        last = self.signal_collection.find_one(sort=[("$natural", pymongo.DESCENDING)])
+        if not last:
+            self.signal_collection.insert_one({"created": datetime.now()})
+            last = self.signal_collection.find_one(sort=[("$natural", pymongo.DESCENDING)])
+        self._last_signal = last["_id"]
+
+    def signal(self):
+        """Wake up consumers blocking in wait().
+        """
+        if self.signal_collection is not None:
+            self.signal_collection.insert_one({"created": datetime.now()})
 
     def close(self):
         """Close the in memory queue connection.
@@ -61,19 +113,22 @@ class MongoQueue(object):
         return self.collection.count()
 
     def repair(self):
-        """Clear out stale locks.
+        """Clear out stale locks, e.g. of killed workers.
 
-        Increments per job attempt counter.
+        Increments per job attempt counter. Every job is put back like
+        _unlock() does, so it gets its pending_key again or is coalesced
+        into a job of the same key which has been put in the meantime.
         """
-        self.collection.find_and_modify(
-            query={
-                "locked_by": {"$ne": None},
-                "locked_at": {
-                    "$lt": datetime.now() - timedelta(self.timeout)}},
-            update={
-                "$set": {"locked_by": None, "locked_at": None},
-                "$inc": {"attempts": 1}}
-        )
+        stale = {"locked_by": {"$ne": None},
+                 "locked_at": {"$lt": self._lock_expiry()}}
+        for data in self.collection.find(stale):
+            self._unlock(data, query=dict(stale, _id=data['_id']))
+
+    def _lock_expiry(self):
+        """Locks older than this are stale. Running jobs keep their lock
+        fresh with Job.progress().
+        """
+        return datetime.now() - timedelta(seconds=self.timeout)
 
     def drop_max_attempts(self):
         """
@@ -82,32 +137,140 @@ class MongoQueue(object):
             {"attempts": {"$gte": self.max_attempts}},
             remove=True)
 
-    def put(self, payload, priority=0):
+    def put(self, payload, priority=0, unique_key=None):
         """Place a job into the queue
+
+        If there is already a waiting job with the same unique_key, the
+        new job is coalesced into it: list values of the payload are
+        merged and the higher priority wins. Jobs with the same key never
+        run at the same time.
         """
         job = dict(DEFAULT_INSERT)
         job['priority'] = priority
         job['payload'] = payload
-        return self.collection.insert(job)
+        if unique_key is None:
+            result = self.collection.insert(job)
+            self.signal()
+            return result
+        job['key'] = unique_key
+        job['pending_key'] = unique_key
+        while True:
+            try:
+                result = self.collection.insert(dict(job))
+                self.signal()
+                return result
+            except DuplicateKeyError:
+                pass
+            existing = self._merge(unique_key, payload, priority)
+            if existing:
+                return existing['_id']
+            # the waiting job was locked in between, so try again
+
+    def _merge(self, unique_key, payload, priority):
+        update = {"$max": {"priority": priority}}
+        merge = dict((
+            ("payload.%s" % key, {"$each": value})
+            for key, value in payload.items() if isinstance(value, list)))
+        if merge:
+            update["$addToSet"] = merge
+        return self.collection.find_and_modify(
+            {"pending_key": unique_key}, update=update, new=True)
 
     def next(self):
-        return self._wrap_one(self.collection.find_and_modify(
-            query={"locked_by": None,
-                   "locked_at": None,
-                   "attempts": {"$lt": self.max_attempts}},
-            update={"$set": {"locked_by": self.consumer_id,
-                             "locked_at": datetime.now()}},
-            sort=[('priority', pymongo.DESCENDING)],
-            new=1,
-            limit=1
-        ))
+        self.repair()
+        skip = []
+        while True:
+            running = self.collection.distinct(
+                "key", {"locked_by": {"$ne": None},
+                        "locked_at": {"$gte": self._lock_expiry()},
+                        "key": {"$ne": None}})
+            data = self.collection.find_and_modify(
+                query={"locked_by": None,
+                       "locked_at": None,
+                       "attempts": {"$lt": self.max_attempts},
+                       "key": {"$nin": running},
+                       "_id": {"$nin": skip}},
+                update={"$set": {"locked_by": self.consumer_id,
+                                 "locked_at": datetime.now()},
+                        "$unset": {"pending_key": 1}},
+                sort=[('priority', pymongo.DESCENDING), ('_id', pymongo.ASCENDING)],
+                new=1,
+                limit=1
+            )
+            if not data or data.get('key') is None:
+                return self._wrap_one(data)
+            # someone else locked a job with the same key at the same
+            # time: the older one wins, this one goes back untouched
+            if not self.collection.find_one({
+                    "key": data['key'],
+                    "locked_by": {"$ne": None},
+                    "locked_at": {"$gte": self._lock_expiry()},
+                    "_id": {"$lt": data['_id']}}):
+                return self._wrap_one(data)
+            self._unlock(data, increment=False)
+            skip.append(data['_id'])
+
+    def _unlock(self, data, increment=True, message=None, query=None):
+        """Put a locked job back, coalescing it with a job of the same
+        key which has been put in the meantime. query selects the job,
+        by default as long as it is locked by this consumer.
+        """
+        if query is None:
+            query = {"_id": data['_id'], "locked_by": self.consumer_id}
+        update = {"$set": {"locked_by": None, "locked_at": None}}
+        if message is not None:
+            update["$set"]["last_error"] = message
+        if increment:
+            update["$inc"] = {"attempts": 1}
+        if data.get('key') is not None:
+            update["$set"]["pending_key"] = data['key']
+        try:
+            result = self.collection.find_and_modify(query, update=update)
+        except DuplicateKeyError:
+            self._merge(data['key'], data['payload'], data['priority'])
+            result = self.collection.find_and_modify(query, remove=True)
+        self.signal()
+        return result
+
+    def wait(self, timeout=1, poll_period=1):
+        """Get the next job, blocking up to timeout seconds until one
+        has been put into the queue. Returns None if there is none.
+        """
+        deadline = time.time() + timeout
+        while True:
+            job = self.next()
+            if job or time.time() >= deadline:
+                return job
+            if not self._wait_for_signal(deadline):
+                # no signal collection or the cursor died: poll
+                time.sleep(max(0, min(poll_period, deadline - time.time())))
+
+    def _wait_for_signal(self, deadline):
+        if self.signal_collection is None:
+            return False
+        cursor = self.signal_collection.find(
+            {"_id": {"$gt": self._last_signal}},
+            cursor_type=CursorType.TAILABLE_AWAIT
+        )
+        try:
+            while cursor.alive and time.time() < deadline:
+                try:
+                    signal = cursor.next()
+                except StopIteration:
+                    # server side await timed out, ask again
+                    continue
+                self._last_signal = signal["_id"]
+                return True
+        finally:
+            cursor.close()
+        return time.time() >= deadline
 
     def _jobs(self):
         return self.collection.find(
             query={"locked_by": None,
                    "locked_at": None,
                    "attempts": {"$lt": self.max_attempts}},
-            sort=[('priority', pymongo.DESCENDING)],
+            sort=[('priority', pymongo.DESCENDING), ('_id', pymongo.ASCENDING)],
         )
 
     def _wrap_one(self, data):
@@ -204,11 +367,7 @@ class Job(object):
     def error(self, message=None):
         """Note an error processing a job, and return it to the queue.
         """
-        self._queue.collection.find_and_modify(
-            {"_id": self.job_id, "locked_by": self._queue.consumer_id},
-            update={"$set": {
-                "locked_by": None, "locked_at": None, "last_error": message},
-                "$inc": {"attempts": 1}})
+        self._queue._unlock(self._data, message=message)
 
     def progress(self, count=0):
         """Note progress on a long running task.
@@ -220,10 +379,7 @@ class Job(object):
     def release(self):
         """Put the job back into_queue.
         """
-        return self._queue.collection.find_and_modify(
-            {"_id": self.job_id, "locked_by": self._queue.consumer_id},
-            update={"$set": {"locked_by": None, "locked_at": None},
-                    "$inc": {"attempts": 1}})
+        return self._queue._unlock(self._data)
 
     ## Context Manager support
 
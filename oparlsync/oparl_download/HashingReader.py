@@ -0,0 +1,51 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import hashlib
+
+
+class HashingReader():
+    """
+    File like wrapper around a stream which computes size, sha1 and sha512 of
+    everything read through it. read(size) always returns size bytes unless the
+    stream is exhausted, as minio expects.
+    """
+
+    def __init__(self, stream, chunk_size=65536):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = b''
+        self.size = 0
+        self.sha1 = hashlib.sha1()
+        self.sha512 = hashlib.sha512()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = self.stream.read(self.chunk_size if size < 0 else max(size - len(self.buffer), self.chunk_size))
+            if not chunk:
+                break
+            self.buffer += chunk
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.size += len(data)
+        self.sha1.update(data)
+        self.sha512.update(data)
+        return data
+
+    def exhaust(self):
+        """
+        Reads the rest of the stream without keeping it, just for size and checksums.
+        """
+        while self.read(self.chunk_size):
+            pass
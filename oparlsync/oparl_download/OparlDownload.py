@@ -11,29 +11,37 @@ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
 """
 
 import re
-import os
 import sys
 import time
 import json
 import pytz
 import minio
 import urllib
-import hashlib
 import datetime
-import requests
+import threading
+from tempfile import SpooledTemporaryFile
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.parser import parse as dateutil_parse
-from ssl import SSLError
 from geojson import Feature
 from urllib.parse import urlparse
 from ..models import *
 from ..base_task import BaseTask
-from pymongo import ReturnDocument
+from .TokenBucket import TokenBucket
+from .ReferenceCache import ReferenceCache
+from .HashingReader import HashingReader
+from pymongo import ReturnDocument, UpdateOne
 from bson.objectid import ObjectId
-from minio.error import ResponseError, SignatureDoesNotMatch
+from minio.error import ResponseError, SignatureDoesNotMatch, InvalidArgumentError, NoSuchKey
 from mongoengine.errors import ValidationError
 from pymongo.errors import ServerSelectionTimeoutError
 
 
+PendingReference = namedtuple('PendingReference', ['object', 'key'])
+# validators of a downloaded list page, stored once the page has been saved
+ListPageValidators = namedtuple('ListPageValidators', ['url', 'etag', 'last_modified'])
+
+
 class OparlDownload(BaseTask):
     name = 'OparlDownload'
     services = [
@@ -73,12 +81,13 @@ class OparlDownload(BaseTask):
         # statistics
         self.mongodb_request_count = 0
         self.mongodb_request_cached = 0
+        self.object_count = 0
         self.http_request_count = 0
         self.mongodb_request_time = 0
         self.file_download_time = 0
         self.download_not_required = 0
+        self.file_deduplicated = 0
         self.http_request_time = 0
-        self.minio_time = 0
         self.wait_time = 0
 
         self.body_uid = False
@@ -87,10 +96,59 @@ class OparlDownload(BaseTask):
         self.meeting_list_url = False
         self.paper_list_url = False
 
+        # concurrent mode: prefetch list pages and sync all body_objects lists at the same time
+        self.concurrent = self.config.OPARL_CONCURRENT_SYNC
+        self.token_buckets = {}
+        self.token_buckets_lock = threading.Lock()
+        # one lock per collection to prevent duplicate upserts of the same object from different lists
+        self.save_locks = {}
+        for obj in self.valid_objects:
+            self.save_locks[obj.__name__] = threading.Lock()
+
+        # file binaries are downloaded and uploaded to s3 in a separate pool
+        self.file_executor = None
+        # counters are changed from the download pool threads as well
+        self.statistics_lock = threading.Lock()
+        self.file_queue_slots = threading.BoundedSemaphore(self.config.FILE_DOWNLOAD_QUEUE_SIZE)
+        # send ETag / Last-Modified of the last download, disabled by full runs
+        self.conditional_requests = True
+
     def reset_cache(self):
+        # all ids of one endpoint share scheme and host, so they don't need to be stored
+        body_config = self.get_body_config(self.body_id)
+        if self.config.USE_MIRROR:
+            url = urlparse(self.config.OPARL_MIRROR_URL)
+        else:
+            url = urlparse(body_config['url'] if body_config else '')
+        prefix = '%s://%s/' % (url.scheme, url.netloc) if url.netloc else ''
         self.cache = {}
         for obj in self.valid_objects:
-            self.cache[obj.__name__] = {}
+            self.cache[obj.__name__] = ReferenceCache(prefix, self.config.OBJECT_CACHE_MAX_SIZE)
+
+    def preload_cache(self):
+        """
+        Fills the cache with all objects of this body which are already in the database, so
+        references to known objects do not need a database round trip.
+        """
+        key_field = 'mirrorId' if self.config.USE_MIRROR else 'originalId'
+        start_time = time.time()
+        for object in self.valid_objects:
+            if object == Body:
+                continue
+            # mongoengine creates the (body, originalId / mirrorId, id) indexes of meta at first access
+            collection = object._get_collection()
+            self.count('mongodb_request_count')
+            documents = collection.find(
+                {'body': self.body_uid, key_field: {'$exists': True}},
+                {key_field: 1}
+            )
+            for document in documents:
+                self.cache[object.__name__][document[key_field]] = document['_id']
+        self.count('mongodb_request_time', time.time() - start_time)
+        self.datalog.info('preloaded %s ids in %s s' % (
+            sum([len(self.cache[object.__name__]) for object in self.valid_objects]),
+            round(time.time() - start_time, 1)
+        ))
 
     def run(self, body_id, *args):
         self.reset_cache()
@@ -111,11 +169,19 @@ class OparlDownload(BaseTask):
         if 'url' not in self.body_config:
             return
         start_time = time.time()
+        self.conditional_requests = not all
         self.get_body()
         if not self.body_uid:
             return
-        for object in self.body_objects:
-            self.get_list(object)
+        self.preload_cache()
+        if self.concurrent:
+            with ThreadPoolExecutor(max_workers=len(self.body_objects)) as executor:
+                # list() raises exceptions from the threads here
+                list(executor.map(self.get_list, self.body_objects))
+        else:
+            for object in self.body_objects:
+                self.get_list(object)
+        self.wait_for_files()
 
         # set last sync if everything is done so far
         body = Body.objects(id=self.body_uid).first()
@@ -123,20 +189,25 @@ class OparlDownload(BaseTask):
         body.save()
 
         self.datalog.info('Body %s sync done. Results:' % body_id)
+        self.datalog.info('objects:              %s' % self.object_count)
         self.datalog.info('mongodb requests:     %s' % self.mongodb_request_count)
         self.datalog.info('cached requests:      %s' % self.mongodb_request_cached)
+        http_statistics = self.get_http_statistics()
         self.datalog.info('http requests:        %s' % self.http_request_count)
+        self.datalog.info('http connections:     %s (%s reused)' % (http_statistics['connections'], http_statistics['reused']))
+        self.datalog.info('http retries:         %s' % http_statistics['retries'])
+        self.datalog.info('http errors:          %s' % http_statistics['errors'])
         self.datalog.info('mongodb time:         %s s' % round(self.mongodb_request_time, 1))
-        self.datalog.info('minio time:           %s s' % round(self.minio_time, 1))
         self.datalog.info('http time:            %s s' % round(self.http_request_time, 1))
-        self.datalog.info('file download time:   %s s' % round(self.file_download_time, 1))
+        self.datalog.info('file download time:   %s s (%s threads, includes minio)' % (round(self.file_download_time, 1), self.config.FILE_DOWNLOAD_THREADS))
         self.datalog.info('download not reqired: %s' % self.download_not_required)
+        self.datalog.info('files deduplicated:   %s' % self.file_deduplicated)
         self.datalog.info('wait time:            %s s' % round(self.wait_time, 1))
         self.datalog.info('app time:             %s s' % round(
-            time.time() - start_time - self.mongodb_request_time - self.minio_time - self.http_request_time - self.wait_time - self.file_download_time,
+            time.time() - start_time - self.mongodb_request_time - self.http_request_time - self.wait_time,
             1))
         self.datalog.info('all time:             %s s' % round(time.time() - start_time, 1))
-        self.datalog.info('processed %s objects per second' % round(self.mongodb_request_count / (time.time() - start_time), 1))
+        self.datalog.info('processed %s objects per second' % round(self.object_count / (time.time() - start_time), 1))
 
     def run_single(self, body_id, *args):
         self.body_config = self.get_body_config(body_id)
@@ -173,6 +244,7 @@ class OparlDownload(BaseTask):
         for oparl_object in self.valid_objects:
             if data['type'] == oparl_object.type:
                 self.save_object(oparl_object, data)
+        self.wait_for_files()
 
     def get_body(self, set_last_sync=True):
         self.body_uid = False
@@ -204,7 +276,7 @@ class OparlDownload(BaseTask):
         if self.config.USE_MIRROR:
             object_json['$set']['mirrorId'] = body_raw['id']
         self.correct_document_values(object_json['$set'])
-        self.mongodb_request_count += 1
+        self.count('mongodb_request_count')
         start_time = time.time()
         result = self.db_raw.body.find_one_and_update(
             query,
@@ -243,7 +315,7 @@ class OparlDownload(BaseTask):
 
     def get_list(self, object, list_url=False):
         if list_url:
-            object_list = self.get_url_json(list_url, is_list=True)
+            object_list = self.get_url_json(list_url, is_list=True, page_cache=True)
         else:
             if self.last_update and (self.body_config['force_full_sync'] == 0 or self.config.USE_MIRROR):
                 last_update_tmp = self.last_update
@@ -254,16 +326,44 @@ class OparlDownload(BaseTask):
                     is_list=True
                 )
             else:
-                object_list = self.get_url_json(getattr(self, '%s_list_url' % object._object_db_name), is_list=True)
-        while object_list:
-            for object_raw in object_list['data']:
-                self.save_object(object, object_raw)
-            if 'next' in object_list['links']:
-                object_list = self.get_url_json(object_list['links']['next'], is_list=True)
-            else:
-                break
+                object_list = self.get_url_json(getattr(self, '%s_list_url' % object._object_db_name), is_list=True, page_cache=True)
+        # in concurrent mode the next page is downloaded while the current one is saved
+        prefetch = ThreadPoolExecutor(max_workers=1) if self.concurrent else None
+        try:
+            while object_list:
+                next_url = object_list['links']['next'] if 'next' in object_list['links'] else None
+                next_list = None
+                if next_url and prefetch:
+                    next_list = prefetch.submit(self.get_url_json, next_url, True, True, True)
+                pending = OrderedDict()
+                for object_raw in object_list['data']:
+                    self.queue_object(object, object_raw, pending)
+                results = self.flush_objects(pending)
+                self.save_list_page(object_list, results)
+                if not next_url:
+                    break
+                if next_list:
+                    object_list = next_list.result()
+                else:
+                    object_list = self.get_url_json(next_url, is_list=True, page_cache=True)
+        finally:
+            if prefetch:
+                prefetch.shutdown()
 
     def save_object(self, object, object_raw, validate=True):
+        """
+        Saves a single object including all sub objects and returns the stored document.
+        """
+        pending = OrderedDict()
+        reference = self.queue_object(object, object_raw, pending, validate)
+        results = self.flush_objects(pending)
+        return results.get((reference.object, reference.key))
+
+    def queue_object(self, object, object_raw, pending, validate=True):
+        """
+        Prepares an object and all of its sub objects for the next flush_objects(). Returns a
+        PendingReference which is resolved to the ObjectId after flushing.
+        """
         object_instance = object()
         dbref_data = {}
 
@@ -303,13 +403,9 @@ class OparlDownload(BaseTask):
                                             sub_object_raw['created'] = object_raw['created']
                                         if 'modified' not in sub_object_raw and 'modified' in object_raw:
                                             sub_object_raw['modified'] = object_raw['modified']
-                                        dbref_data[key].append(ObjectId(self.save_object(valid_object, sub_object_raw, True)['_id']))
+                                        dbref_data[key].append(self.queue_object(valid_object, sub_object_raw, pending, True))
                                     else:
-                                        if single in self.cache[valid_object.__name__]:
-                                            dbref_data[key].append(self.cache[valid_object.__name__][single])
-                                            self.mongodb_request_cached += 1
-                                            continue
-                                        dbref_data[key].append(ObjectId(self.save_object(valid_object, {'id': single}, False)['_id']))
+                                        dbref_data[key].append(self.queue_reference(valid_object, single, pending))
                     # List of Non-Relation
                     else:
                         self.save_document_values(object_instance, key, value)
@@ -332,13 +428,9 @@ class OparlDownload(BaseTask):
                                     sub_object_raw['created'] = object_raw['created']
                                 if 'modified' not in sub_object_raw and 'modified' in object_raw:
                                     sub_object_raw['modified'] = object_raw['modified']
-                                dbref_data[key] = ObjectId(self.save_object(valid_object, sub_object_raw, True)['_id'])
+                                dbref_data[key] = self.queue_object(valid_object, sub_object_raw, pending, True)
                             else:
-                                if value in self.cache[valid_object.__name__]:
-                                    dbref_data[key] = self.cache[valid_object.__name__][value]
-                                    self.mongodb_request_cached += 1
-                                    continue
-                                dbref_data[key] = ObjectId(self.save_object(valid_object, {'id': value}, False)['_id'])
+                                dbref_data[key] = self.queue_reference(valid_object, value, pending)
                 # No relation or list
                 else:
                     self.save_document_values(object_instance, key, value)
@@ -406,113 +498,172 @@ class OparlDownload(BaseTask):
             if self.config.OPARL_MIRROR_PREFIX + ':originalDownloadUrl' in object_raw:
                 object_json['originalDownloadUrl'] = object_raw[self.config.OPARL_MIRROR_PREFIX + ':originalDownloadUrl']
 
-        # set all the dbrefs generated before
-        object_json.update(dbref_data)
-
-        # delete empty lists and dicts
+        # delete empty lists and dicts, dbrefs are added after flushing
         for key in list(object_json):
-            if (isinstance(object_json[key], list) or isinstance(object_json[key], dict)) and not object_json[key]:
+            if key in dbref_data:
                 del object_json[key]
+            elif (isinstance(object_json[key], list) or isinstance(object_json[key], dict)) and not object_json[key]:
+                del object_json[key]
+        self.correct_document_values(object_json)
+
+        key_field = list(query.keys())[0]
+        pending_key = (object.__name__, query[key_field])
+        if pending_key in pending:
+            # same object twice on one page: bare references never overwrite real data
+            if validate:
+                pending[pending_key]['set'].update(object_json)
+                pending[pending_key]['dbrefs'].update(dbref_data)
+                pending[pending_key]['stub'] = False
+        else:
+            pending[pending_key] = {
+                'object': object,
+                'query': query,
+                'set': object_json,
+                'dbrefs': dbref_data,
+                'stub': not validate
+            }
+        return PendingReference(object.__name__, query[key_field])
 
-        # Save data
-        object_json = { '$set': object_json }
-        self.correct_document_values(object_json['$set'])
-        self.mongodb_request_count += 1
-        start_time = time.time()
-        result = self.db_raw[object._object_db_name].find_one_and_update(
-            query,
-            object_json,
-            upsert=True,
-            return_document=ReturnDocument.AFTER
-        )
-        self.datalog.debug('%s %s from Body %s saved successfully.' % (object.__name__, result['_id'], self.body_uid))
-        self.mongodb_request_time += time.time() - start_time
-
+    def queue_reference(self, object, url, pending):
         # Cache Original ID -> MongoDB ID
-        if self.config.USE_MIRROR:
-            if object_instance.mirrorId not in self.cache[object.__name__]:
-                self.cache[object.__name__][object_instance.mirrorId] = ObjectId(result['_id'])
-        else:
-            if object_instance.originalId not in self.cache[object.__name__]:
-                self.cache[object.__name__][object_instance.originalId] = ObjectId(result['_id'])
+        if url in self.cache[object.__name__]:
+            self.count('mongodb_request_cached')
+            return self.cache[object.__name__][url]
+        return self.queue_object(object, {'id': url}, pending, False)
+
+    def flush_objects(self, pending):
+        """
+        Writes all queued objects with one bulk upsert per collection, resolves all ids with one
+        $in query per collection and finally sets all references which were not known before.
+        Returns the stored documents by (object name, original id).
+        """
+        if not pending:
+            return {}
+        key_field = 'mirrorId' if self.config.USE_MIRROR else 'originalId'
+        results = {}
+        collections = OrderedDict()
+        for pending_key, item in pending.items():
+            if item['object'].__name__ not in collections:
+                collections[item['object'].__name__] = []
+            collections[item['object'].__name__].append(pending_key)
+
+        # upsert everything which does not need unresolved ids
+        for object_name, pending_keys in collections.items():
+            object = pending[pending_keys[0]]['object']
+            operations = []
+            for pending_key in pending_keys:
+                item = pending[pending_key]
+                object_json = item['set']
+                for key, value in item['dbrefs'].items():
+                    if self.dbref_resolved(value, results):
+                        object_json[key] = self.resolve_dbref(value, results)
+                        if not object_json[key]:
+                            del object_json[key]
+                operations.append(UpdateOne(item['query'], {'$set': object_json}, upsert=True))
+            self.count('mongodb_request_count')
+            start_time = time.time()
+            with self.save_locks[object_name]:
+                self.db_raw[object._object_db_name].bulk_write(operations, ordered=False)
+            self.count('mongodb_request_time', time.time() - start_time)
 
+            # get all ids
+            self.count('mongodb_request_count')
+            start_time = time.time()
+            projection = {key_field: 1}
+            if object == File:
+                projection['downloaded'] = 1
+                projection['originalEtag'] = 1
+                projection['originalLastModified'] = 1
+                projection['downloadedChecksum'] = 1
+            documents = self.db_raw[object._object_db_name].find(
+                {key_field: {'$in': [pending_key[1] for pending_key in pending_keys]}},
+                projection
+            )
+            for document in documents:
+                results[(object_name, document[key_field])] = document
+                if document[key_field] not in self.cache[object_name]:
+                    self.cache[object_name][document[key_field]] = ObjectId(document['_id'])
+            self.count('mongodb_request_time', time.time() - start_time)
+
+        # set references which were unknown at the first write
+        for object_name, pending_keys in collections.items():
+            object = pending[pending_keys[0]]['object']
+            operations = []
+            for pending_key in pending_keys:
+                item = pending[pending_key]
+                object_json = {}
+                for key, value in item['dbrefs'].items():
+                    if key not in item['set']:
+                        object_json[key] = self.resolve_dbref(value, results)
+                        if not object_json[key]:
+                            del object_json[key]
+                if object_json and pending_key in results:
+                    operations.append(UpdateOne({'_id': results[pending_key]['_id']}, {'$set': object_json}))
+                    item['set'].update(object_json)
+            if not operations:
+                continue
+            self.count('mongodb_request_count')
+            start_time = time.time()
+            self.db_raw[object._object_db_name].bulk_write(operations, ordered=False)
+            self.count('mongodb_request_time', time.time() - start_time)
+
+        for pending_key, item in pending.items():
+            if pending_key not in results:
+                self.datalog.warn('%s %s from Body %s could not be saved.' % (pending_key[0], pending_key[1], self.body_uid))
+                continue
+            self.count('object_count')
+            self.datalog.debug('%s %s from Body %s saved successfully.' % (pending_key[0], results[pending_key]['_id'], self.body_uid))
+            self.after_save_object(item['object'], item['set'], results[pending_key])
+        return results
+
+    def dbref_resolved(self, value, results):
+        if isinstance(value, list):
+            for single in value:
+                if not self.dbref_resolved(single, results):
+                    return False
+            return True
+        if isinstance(value, PendingReference):
+            return (value.object, value.key) in results or value.key in self.cache[value.object]
+        return True
+
+    def resolve_dbref(self, value, results):
+        if isinstance(value, list):
+            resolved = []
+            for single in value:
+                single = self.resolve_dbref(single, results)
+                if single:
+                    resolved.append(single)
+            return resolved
+        if isinstance(value, PendingReference):
+            if (value.object, value.key) in results:
+                return ObjectId(results[(value.object, value.key)]['_id'])
+            if value.key in self.cache[value.object]:
+                return self.cache[value.object][value.key]
+            return None
+        return value
+
+    def after_save_object(self, object, object_json, result):
         # We need to download files if necessary
         if object == File and not self.config.USE_MIRROR:
             download_file = True
-            if self.body_config['force_full_sync'] == 1 and self.last_update and object_instance.modified:
-                if object_instance.modified < self.last_update:
+            if self.body_config['force_full_sync'] == 1 and self.last_update and object_json.get('modified'):
+                if object_json.get('modified') < self.last_update:
                     download_file = False
             if 'downloaded' not in result:
                 download_file = True
             elif not result['downloaded']:
                 download_file = True
-            if 'originalAccessUrl' in object_json['$set'] and download_file:
-                file_name_internal = str(result['_id'])
-                start_time = time.time()
-                file_status = self.download_file(object_json['$set']['originalAccessUrl'], file_name_internal)
-                self.file_download_time += time.time() - start_time
-                if not file_status:
-                    self.datalog.warn('No valid file could be downloaded at File %s from Body %s' % (result['_id'], self.body_uid))
-                else:
-                    start_time = time.time()
-                    object_json_update = {}
-                    mime_type = None
-                    if 'mimeType' in object_json['$set']:
-                        mime_type = object_json['$set']['mimeType']
-                    file_name = None
-                    if 'fileName' in object_json['$set']:
-                        file_name = object_json['$set']['fileName']
-                    else:
-                        splitted_file_name = object_json['$set']['originalAccessUrl'].split('/')
-                        if len(splitted_file_name):
-                            if len(splitted_file_name[-1]) > 3 and '.' in splitted_file_name[-1]:
-                                file_name = splitted_file_name[-1]
-                    if not file_name or not mime_type:
-                        self.datalog.warn('No file name or no mime type avaliable at File %s from Body %s' % (
-                        result['_id'], self.body_uid))
-                    else:
-                        content_type = object_json['$set']['mimeType']
-                        metadata = {
-                            'Content-Disposition': 'filename=%s' % file_name
-                        }
-                        try:
-                            self.s3.fput_object(
-                                self.config.S3_BUCKET,
-                                "files/%s/%s" % (self.body_uid, file_name_internal),
-                                os.path.join(self.config.TMP_FILE_DIR, file_name_internal),
-                                content_type=content_type,
-                                metadata=metadata
-                            )
-                            self.datalog.debug('Binary file at File %s from Body %s saved successfully.' % (result['_id'], self.body_uid))
-                            object_json_update['downloaded'] = True
-                        except (ResponseError, SignatureDoesNotMatch) as err:
-                            self.datalog.warn(
-                                'Critical error saving file from File %s from Body %s' % (result['_id'], self.body_uid))
-                    self.minio_time += time.time() - start_time
-                    if 'size' not in object_json['$set']:
-                        object_json_update['size'] = os.path.getsize(os.path.join(self.config.TMP_FILE_DIR, file_name_internal))
-                    if 'sha1Checksum' not in object_json['$set'] or 'sha512Checksum' not in object_json['$set']:
-                        with open(os.path.join(self.config.TMP_FILE_DIR, file_name_internal), 'rb') as checksum_file:
-                            checksum_file_content = checksum_file.read()
-                            if 'sha1Checksum' not in object_json['$set']:
-                                object_json_update['sha1Checksum'] = hashlib.sha1(checksum_file_content).hexdigest()
-                            if 'sha512Checksum' not in object_json['$set']:
-                                object_json_update['sha512Checksum'] = hashlib.sha512(checksum_file_content).hexdigest()
-                    if len(object_json_update.keys()):
-                        result = self.db_raw[object._object_db_name].find_one_and_update(
-                            query,
-                            { '$set': object_json_update },
-                            upsert=True,
-                            return_document=ReturnDocument.AFTER
-                        )
-                        self.mongodb_request_count += 1
-                    os.remove(os.path.join(self.config.TMP_FILE_DIR, file_name_internal))  # also get all derivativeFile
+            if 'originalAccessUrl' in object_json and download_file:
+                headers = {}
+                if result.get('downloaded') and self.conditional_requests:
+                    headers = self.get_conditional_headers(result.get('originalEtag'), result.get('originalLastModified'))
+                self.queue_file(result['_id'], object_json, headers, result.get('downloadedChecksum'))
             else:
-                self.download_not_required += 1
+                self.count('download_not_required')
 
         # If we have a Paper with a Location, we need to mark this as official=ris relation if processing is enabled
-        if object == Paper and 'location' in object_json['$set'] and self.config.ENABLE_PROCESSING and False:
-            for location_obj_id in object_json['$set']['location']:
+        if object == Paper and 'location' in object_json and self.config.ENABLE_PROCESSING and False:
+            for location_obj_id in object_json['location']:
                 if not LocationOrigin.objects(paper=ObjectId(result['_id']), location=location_obj_id, origin='ris').no_cache().count():
                     location_origin = LocationOrigin()
                     location_origin.location = location_obj_id
@@ -520,19 +671,16 @@ class OparlDownload(BaseTask):
                     location_origin.origin = 'ris'
 
                     location_origin.save()
-                    self.mongodb_request_count += 3
+                    self.count('mongodb_request_count', 3)
                     paper = Paper.objects(id=ObjectId(result['_id'])).no_cache().first()
                     if location_origin.id not in paper.locationOrigin:
                         paper.locationOrigin.append(location_origin.id)
                         paper.save()
-                        self.mongodb_request_count += 1
+                        self.count('mongodb_request_count')
                     # delete refs
                     location_origin = None
                     paper = None
 
-        return result
-
-
     def save_document_values(self, document, key, value):
         if type(document._fields[key]).__name__ == 'DateTimeField':
             try:
@@ -562,20 +710,38 @@ class OparlDownload(BaseTask):
                 if '$date' in value:
                     document_json[key] = datetime.datetime.fromtimestamp(value['$date'] / 1000).isoformat()
 
-    def get_url_json(self, url, is_list=False, wait=True):
+    def get_url_json(self, url, is_list=False, wait=True, page_cache=False):
         if url:
+            # modified_since urls change every run, so there is nothing to gain from conditional requests
+            page_cache = page_cache and is_list and 'modified_since' not in url
+            page = None
+            headers = {}
+            if page_cache and self.conditional_requests:
+                start_time = time.time()
+                page = self.db_raw[ListPage._get_collection_name()].find_one({'url': url, 'body': self.body_uid})
+                self.count('mongodb_request_count')
+                self.count('mongodb_request_time', time.time() - start_time)
+                if page and self.list_page_files_missing(page):
+                    # the page has to be processed again to queue its missing binaries
+                    page = None
+                if page:
+                    headers = self.get_conditional_headers(page.get('etag'), page.get('lastModified'))
             if wait:
-                if 'wait_time' in self.body_config:
-                    self.wait_time += self.body_config['wait_time']
-                    time.sleep(self.body_config['wait_time'])
-                else:
-                    self.wait_time += self.config.GET_URL_WAIT_TIME
-                    time.sleep(self.config.GET_URL_WAIT_TIME)
+                self.count('wait_time', self.get_token_bucket(url).consume())
             self.datalog.info('%s: get %s' % (self.body_config['id'], url))
-            self.http_request_count += 1
+            self.count('http_request_count')
             start_time = time.time()
-            r = requests.get(url)
-            self.http_request_time += time.time() - start_time
+            r = self.http_get(url, headers=headers)
+            self.count('http_request_time', time.time() - start_time)
+            if not r:
+                return False
+            if r.status_code == 304 and page:
+                # page did not change: skip its objects and just go on with the next page
+                self.count('download_not_required')
+                return {
+                    'data': [],
+                    'links': {'next': page['next']} if page.get('next') else {}
+                }
             if r.status_code == 500:
                 self.send_mail(
                     self.config.ADMINS,
@@ -590,20 +756,267 @@ class OparlDownload(BaseTask):
                     else:
                         list_data = r.json()
                         if 'data' in list_data and 'links' in list_data:
+                            if page_cache and (r.headers.get('ETag') or r.headers.get('Last-Modified')):
+                                list_data['_listPage'] = ListPageValidators(url, r.headers.get('ETag'), r.headers.get('Last-Modified'))
                             return list_data
                 except json.decoder.JSONDecodeError:
                     return False
         return False
 
-    def download_file(self, url, file_name):
+    def save_list_page(self, list_data, results):
+        """
+        Stores the validators of a list page after all of its objects were saved and its Files were
+        queued, so a crash or a failed write never turns into a 304 for unsaved objects.
+        """
+        if '_listPage' not in list_data:
+            return
+        validators = list_data['_listPage']
+        start_time = time.time()
+        self.db_raw[ListPage._get_collection_name()].update_one(
+            {'url': validators.url, 'body': self.body_uid},
+            {'$set': {
+                'etag': validators.etag,
+                'lastModified': validators.last_modified,
+                'next': list_data['links'].get('next'),
+                'files': [result['_id'] for key, result in results.items() if key[0] == File.__name__],
+                'modified': datetime.datetime.utcnow()
+            }},
+            upsert=True
+        )
+        self.count('mongodb_request_count')
+        self.count('mongodb_request_time', time.time() - start_time)
+
+    def list_page_files_missing(self, page):
+        """
+        True if a File of a cached list page has a binary which was never downloaded.
+        """
+        if not page.get('files'):
+            return False
+        start_time = time.time()
+        missing = self.db_raw[File._object_db_name].find_one(
+            {'_id': {'$in': page['files']}, 'originalAccessUrl': {'$exists': True}, 'downloaded': {'$ne': True}},
+            {'_id': 1}
+        )
+        self.count('mongodb_request_count')
+        self.count('mongodb_request_time', time.time() - start_time)
+        return missing is not None
+
+    def get_conditional_headers(self, etag, last_modified):
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def count(self, key, value=1):
+        with self.statistics_lock:
+            setattr(self, key, getattr(self, key) + value)
+
+    def get_token_bucket(self, url):
+        host = urlparse(url).netloc
+        with self.token_buckets_lock:
+            if host not in self.token_buckets:
+                if 'wait_time' in self.body_config:
+                    wait_time = self.body_config['wait_time']
+                else:
+                    wait_time = self.config.GET_URL_WAIT_TIME
+                # wait_time 0 means no rate limit at all
+                rate = 1 / wait_time if wait_time else None
+                self.token_buckets[host] = TokenBucket(rate, self.config.GET_URL_BURST)
+            return self.token_buckets[host]
+
+    def queue_file(self, file_id, object_json, headers=None, checksum=None):
+        """
+        Hands the binary of a File to the download pool. Blocks if too many files are waiting, so the
+        metadata sync cannot run away from the downloads.
+        """
+        headers = headers or {}
+        if not self.file_executor:
+            self.file_executor = ThreadPoolExecutor(max_workers=self.config.FILE_DOWNLOAD_THREADS)
+        self.file_queue_slots.acquire()
+        future = self.file_executor.submit(self.store_file, file_id, object_json, headers, checksum)
+        future.add_done_callback(lambda future: self.file_queue_slots.release())
+
+    def wait_for_files(self):
+        if self.file_executor:
+            self.file_executor.shutdown(wait=True)
+            self.file_executor = None
+
+    def store_file(self, file_id, object_json, headers, checksum):
+        try:
+            self.download_file(file_id, object_json, headers, checksum)
+        except Exception as err:
+            self.datalog.warn('Critical error downloading File %s from Body %s: %s' % (file_id, self.body_uid, err))
+
+    def download_file(self, file_id, object_json, headers=None, checksum=None):
+        """
+        Streams the binary of a File directly to S3 while computing size and checksums, then records
+        the result at the File. headers may contain conditional headers of the last download, checksum
+        is the sha512 of the last download.
+        """
+        mime_type = object_json.get('mimeType')
+        file_name = None
+        if 'fileName' in object_json:
+            file_name = object_json['fileName']
+        else:
+            splitted_file_name = object_json['originalAccessUrl'].split('/')
+            if len(splitted_file_name):
+                if len(splitted_file_name[-1]) > 3 and '.' in splitted_file_name[-1]:
+                    file_name = splitted_file_name[-1]
+
+        if self.config.FILE_DEDUPLICATION and self.deduplicate_by_metadata(file_id, object_json, checksum):
+            return
+
+        # file downloads share the rate limit of the endpoint with the list requests. the wait counts as
+        # file download time, as it happens in the download threads.
+        start_time = time.time()
+        self.get_token_bucket(object_json['originalAccessUrl']).consume()
+        r = self.http_get(object_json['originalAccessUrl'], stream=True, headers=headers or {})
+        if r and r.status_code == 304:
+            r.close()
+            self.count('file_download_time', time.time() - start_time)
+            self.count('download_not_required')
+            return
+        if not r or r.status_code != 200:
+            self.count('file_download_time', time.time() - start_time)
+            self.datalog.warn('No valid file could be downloaded at File %s from Body %s' % (file_id, self.body_uid))
+            return
+        r.raw.decode_content = True
+        object_json_update = {}
+        object_json_remove = {}
+        if r.headers.get('ETag'):
+            object_json_update['originalEtag'] = r.headers['ETag']
+        if r.headers.get('Last-Modified'):
+            object_json_update['originalLastModified'] = r.headers['Last-Modified']
+        with r:
+            if not file_name or not mime_type:
+                self.datalog.warn('No file name or no mime type avaliable at File %s from Body %s' % (file_id, self.body_uid))
+                reader = HashingReader(r.raw)
+                reader.exhaust()
+            else:
+                reader = self.upload_file(file_id, file_name, mime_type, r)
+                if reader:
+                    self.datalog.debug('Binary file at File %s from Body %s saved successfully.' % (file_id, self.body_uid))
+                    object_json_update['downloaded'] = True
+        self.count('file_download_time', time.time() - start_time)
+        if not reader:
+            return
+        if 'size' not in object_json:
+            object_json_update['size'] = reader.size
+        if 'sha1Checksum' not in object_json:
+            object_json_update['sha1Checksum'] = reader.sha1.hexdigest()
+        if 'sha512Checksum' not in object_json:
+            object_json_update['sha512Checksum'] = reader.sha512.hexdigest()
+        object_json_update['downloadedChecksum'] = reader.sha512.hexdigest()
+        if checksum and checksum != object_json_update['downloadedChecksum']:
+            # the binary changed, so everything generated from it has to be generated again
+            for key in self.file_generated_fields:
+                object_json_remove[key] = 1
+        if object_json_update.get('downloaded'):
+            if self.config.FILE_DEDUPLICATION and self.deduplicate_file(file_id, reader.sha512.hexdigest()):
+                object_json_update['binaryChecksum'] = reader.sha512.hexdigest()
+            else:
+                object_json_remove['binaryChecksum'] = 1
+        if len(object_json_update.keys()):
+            update = {'$set': object_json_update}
+            if len(object_json_remove.keys()):
+                update['$unset'] = object_json_remove
+            self.db_raw[File._object_db_name].update_one({'_id': file_id}, update)
+            self.count('mongodb_request_count')
+
+    file_generated_fields = [
+        'text',
+        'textStatus',
+        'textGenerated',
+        'thumbnail',
+        'thumbnailFormat',
+        'thumbnailStatus',
+        'thumbnailGenerated',
+        'pages',
+        'georeferencesStatus',
+        'georeferencesGenerated'
+    ]
+
+    def deduplicate_by_metadata(self, file_id, object_json, previous_checksum=None):
+        """
+        Skips the download if the OParl metadata announces the same sha512 checksum we computed at the
+        last download and the binary is still in the content store. The upstream checksum alone is never
+        trusted, as it may be wrong or stale.
+        """
+        checksum = str(object_json.get('sha512Checksum', '')).lower()
+        if not previous_checksum or checksum != previous_checksum:
+            return False
+        if not self.s3_object_exists(self.get_file_object_name(self.body_uid, file_id, checksum)):
+            return False
+        self.db_raw[File._object_db_name].update_one(
+            {'_id': file_id},
+            {'$set': {'downloaded': True, 'binaryChecksum': checksum}}
+        )
+        self.count('mongodb_request_count')
+        self.count('file_deduplicated')
+        return True
+
+    def deduplicate_file(self, file_id, checksum):
+        """
+        Moves a freshly uploaded binary to the content store. If the store already has it, the upload is
+        just dropped.
+        """
+        object_name = self.get_file_object_name(self.body_uid, file_id)
+        content_name = self.get_file_object_name(self.body_uid, file_id, checksum)
         try:
-            r = requests.get(url, stream=True)
-        except SSLError:
+            if self.s3_object_exists(content_name):
+                self.count('file_deduplicated')
+            else:
+                self.s3.copy_object(self.config.S3_BUCKET, content_name, '/%s/%s' % (self.config.S3_BUCKET, object_name))
+            self.s3.remove_object(self.config.S3_BUCKET, object_name)
+        except ResponseError:
+            self.datalog.warn('Critical error deduplicating file from File %s from Body %s' % (file_id, self.body_uid))
             return False
-        if r.status_code != 200:
+        return True
+
+    def s3_object_exists(self, object_name):
+        try:
+            self.s3.stat_object(self.config.S3_BUCKET, object_name)
+        except NoSuchKey:
             return False
-        with open(os.path.join(self.config.TMP_FILE_DIR, file_name), 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
         return True
+
+    def upload_file(self, file_id, file_name, mime_type, r):
+        metadata = {
+            'Content-Disposition': 'filename=%s' % file_name
+        }
+        object_name = self.get_file_object_name(self.body_uid, file_id)
+        # the length is just known in advance if the body is not compressed
+        length = r.headers.get('Content-Length')
+        if length and not r.headers.get('Content-Encoding'):
+            reader = HashingReader(r.raw)
+            data = reader
+            length = int(length)
+        else:
+            # unknown length: hash while spooling, minio needs the size before upload
+            reader = HashingReader(r.raw)
+            data = SpooledTemporaryFile(max_size=self.config.FILE_SPOOL_MAX_SIZE, dir=self.config.TMP_FILE_DIR)
+            while True:
+                chunk = reader.read(reader.chunk_size)
+                if not chunk:
+                    break
+                data.write(chunk)
+            length = reader.size
+            data.seek(0)
+        try:
+            self.s3.put_object(
+                self.config.S3_BUCKET,
+                object_name,
+                data,
+                length,
+                content_type=mime_type,
+                metadata=metadata
+            )
+        except (ResponseError, SignatureDoesNotMatch, InvalidArgumentError) as err:
+            self.datalog.warn('Critical error saving file from File %s from Body %s' % (file_id, self.body_uid))
+            return None
+        finally:
+            if data is not reader:
+                data.close()
+        return reader
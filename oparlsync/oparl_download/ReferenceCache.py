@@ -0,0 +1,51 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2012 - 2016, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from bson.objectid import ObjectId
+
+
+class ReferenceCache():
+    """
+    Compact map of originalId (or mirrorId) to ObjectId for one object type. Keys are stored
+    without the common url prefix of the endpoint and ObjectIds in their 12 byte binary form.
+    If max_size entries are stored, new entries are ignored, so memory stays bounded and
+    lookups of not cached ids just fall back to MongoDB.
+    """
+
+    def __init__(self, prefix='', max_size=None):
+        self.prefix = prefix
+        self.max_size = max_size
+        self.data = {}
+
+    def get_key(self, key):
+        if self.prefix and key.startswith(self.prefix):
+            return key[len(self.prefix):]
+        # mark keys without prefix so they cannot collide with shortened ones
+        return '\0' + key
+
+    def __contains__(self, key):
+        if not isinstance(key, str):
+            return False
+        return self.get_key(key) in self.data
+
+    def __getitem__(self, key):
+        return ObjectId(self.data[self.get_key(key)])
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, str):
+            return
+        if self.max_size and len(self.data) >= self.max_size:
+            return
+        self.data[self.get_key(key)] = ObjectId(value).binary
+
+    def __len__(self):
+        return len(self.data)
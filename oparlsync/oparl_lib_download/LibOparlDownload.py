@@ -15,7 +15,6 @@ import os
 import time
 import json
 import datetime
-import requests
 import dateutil
 from ..models import *
 from pymongo import ReturnDocument
@@ -250,9 +249,9 @@ class LibOparlDownload():
             self.main.datalog.info('%s: get %s' % (self.body_config['id'], url))
             self.http_request_count += 1
             start_time = time.time()
-            r = requests.get(url)
+            r = self.main.http_get(url)
             self.http_request_time += time.time() - start_time
-            if r.status_code == 200:
+            if r and r.status_code == 200:
                 if not is_list:
                     return r.json()
                 else:
@@ -262,8 +261,8 @@ class LibOparlDownload():
         return False
 
     def get_file(self, url, file_name):
-        r = requests.get(url, stream=True)
-        if r.status_code != 200:
+        r = self.main.http_get(url, stream=True)
+        if not r or r.status_code != 200:
             return False
         with open(os.path.join(self.main.config.TMP_FILE_DIR, file_name), 'wb') as f:
             for chunk in r.iter_content(chunk_size=1024):
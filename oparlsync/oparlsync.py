@@ -25,6 +25,7 @@ from multiprocessing import Value
 from setproctitle import setproctitle
 from .config import get_config
 from .mongoqueue import MongoQueue
+from .pipeline import Pipeline
 
 from .worker import Worker
 
@@ -75,6 +76,9 @@ class OparlSync():
         current_module = self.modules[module](body_id)
         current_module.run(body_id, *args)
 
+    def reindex(self):
+        ElasticsearchImport(None).reindex()
+
     def queue_add(self, module, body_id, *args):
         self.init_queue()
         if module not in self.modules:
@@ -85,19 +89,11 @@ class OparlSync():
                 if body[-4:] == 'json':
                     body_config = self.get_body_config(filename=body)
                     if body_config['active'] and 'legacy' not in body_config:
-                        payload = {
-                            'module': module,
-                            'body_id': body_config['id']
-                        }
-                        self.queue_network.put(payload)
+                        self.pipeline.start(module, body_config['id'])
         else:
             if not os.path.isfile(os.path.join(self.config.BODY_DIR, body_id + '.json')):
                 sys.exit('fatal: body config does not exist')
-            payload = {
-                'module': module,
-                'body_id': body_id
-            }
-            self.queue_network.put(payload)
+            self.pipeline.start(module, body_id)
 
     def queue_clear(self):
         self.init_queue()
@@ -224,9 +220,10 @@ class OparlSync():
         self.queue_network = MongoQueue(
             db_raw.queue_network,
             consumer_id="main",
-            timeout=300,
+            timeout=self.config.QUEUE_LOCK_TIMEOUT,
             max_attempts=3
         )
+        self.pipeline = Pipeline(db_raw, self.queue_network, self.config.ENABLE_PROCESSING, self.config.PIPELINE_RUN_TTL)
 
     def init_statuslog(self):
         self.statuslog = logging.getLogger('statuslog')
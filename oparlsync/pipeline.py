@@ -0,0 +1,193 @@
+# encoding: utf-8
+
+"""
+Copyright (c) 2017, Ernesto Ruge
+All rights reserved.
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+
+
+class Pipeline():
+    """
+    Runs the stages of one body as a dependency graph. Every run is stored in the pipeline_run
+    collection, the run ids travel with the job payload. A stage is queued as soon as all its
+    dependencies in the run succeeded, so independent stages run in parallel at different workers.
+    Jobs of the same stage and body are coalesced by the queue, so one job may serve several runs.
+    Running stages without heartbeat for longer than the queue timeout count as failed, runs are removed
+    run_ttl seconds after their last change.
+    """
+
+    stages = {
+        'oparl_download': [],
+        'generate_backrefs': ['oparl_download'],
+        'generate_thumbnails': ['oparl_download'],
+        'generate_fulltext': ['oparl_download'],
+        'generate_georeferences': ['generate_backrefs', 'generate_fulltext'],
+        'elasticsearch_import': ['generate_georeferences'],
+        'generate_sitemap': ['oparl_download'],
+        'misc': ['oparl_download']
+    }
+
+    # stages which still run if ENABLE_PROCESSING is False
+    stages_without_processing = ['oparl_download', 'generate_backrefs']
+
+    def __init__(self, db, queue, enable_processing=True, run_ttl=7 * 24 * 3600):
+        self.collection = db.pipeline_run
+        self.collection.create_index('modified', expireAfterSeconds=run_ttl)
+        self.collection.create_index([('running', 1), ('modified', 1)])
+        self.queue = queue
+        if enable_processing:
+            self.graph = dict(self.stages)
+        else:
+            self.graph = {}
+            for stage in self.stages_without_processing:
+                self.graph[stage] = [dependency for dependency in self.stages[stage] if dependency in self.stages_without_processing]
+
+    def get_descendants(self, stage):
+        descendants = [stage]
+        for descendant in descendants:
+            for name, dependencies in self.graph.items():
+                if descendant in dependencies and name not in descendants:
+                    descendants.append(name)
+        return descendants
+
+    def get_ancestors(self, stage):
+        ancestors = list(self.graph.get(stage, []))
+        for ancestor in ancestors:
+            for dependency in self.graph.get(ancestor, []):
+                if dependency not in ancestors:
+                    ancestors.append(dependency)
+        return ancestors
+
+    def start(self, module, body_id):
+        """
+        Starts a run at module. Stages depending on module follow, all other stages are left out.
+        Modules which are not part of the graph are queued as a single job.
+        """
+        if module not in self.graph:
+            return self.put(module, body_id, [])
+        stages = {}
+        for stage in self.get_descendants(module):
+            stages[stage] = 'pending'
+        stages[module] = 'queued'
+        run_id = self.collection.insert_one({
+            'body_id': body_id,
+            'created': datetime.utcnow(),
+            'modified': datetime.utcnow(),
+            'stages': stages
+        }).inserted_id
+        return self.put(module, body_id, [run_id])
+
+    def put(self, module, body_id, run_ids):
+        return self.queue.put(
+            {'module': module, 'body_id': body_id, 'run_ids': run_ids},
+            unique_key='%s:%s' % (module, body_id)
+        )
+
+    def stage_started(self, payload):
+        for run_id in payload.get('run_ids', []):
+            self.set_stage_status(run_id, payload['module'], 'running')
+
+    def stage_alive(self, payload):
+        """
+        Heartbeat of a running stage, so it does not expire.
+        """
+        self.collection.update_many(
+            {'_id': {'$in': payload.get('run_ids', [])}},
+            {'$set': {'modified': datetime.utcnow()}}
+        )
+
+    def expire_stages(self):
+        """
+        Fails running stages without heartbeat for longer than the queue timeout, e.g. of killed workers,
+        and skips the stages depending on them. The queue repairs the job of such a stage, if its retry
+        succeeds the skipped stages are reopened by run_finished.
+        """
+        expiry = datetime.utcnow() - timedelta(seconds=self.queue.timeout)
+        for run in self.collection.find({'running.0': {'$exists': True}, 'modified': {'$lt': expiry}}):
+            for stage in run['running']:
+                expired = self.collection.find_one_and_update(
+                    {'_id': run['_id'], 'stages.%s' % stage: 'running', 'modified': {'$lt': expiry}},
+                    {'$set': {'stages.%s' % stage: 'failed'}, '$pull': {'running': stage}},
+                    return_document=ReturnDocument.AFTER
+                )
+                if expired:
+                    self.skip_descendants(expired, stage)
+
+    def stage_finished(self, payload, successful):
+        """
+        Stores the result of a stage and queues all stages which are ready now. If the stage failed, all
+        stages depending on it are skipped.
+        """
+        for run_id in payload.get('run_ids', []):
+            self.run_finished(run_id, payload, successful)
+
+    def run_finished(self, run_id, payload, successful):
+        run = self.set_stage_status(run_id, payload['module'], 'successful' if successful else 'failed')
+        if not run:
+            return
+        if not successful:
+            self.skip_descendants(run, payload['module'])
+            return
+        run = self.reopen_descendants(run, payload['module'])
+        for stage, dependencies in self.graph.items():
+            if run['stages'].get(stage) != 'pending' or payload['module'] not in dependencies:
+                continue
+            # dependencies which are not part of this run count as done
+            if any(run['stages'].get(dependency, 'successful') != 'successful' for dependency in dependencies):
+                continue
+            # just one worker may queue the stage, even if dependencies finish at the same time
+            queued = self.collection.find_one_and_update(
+                {'_id': run['_id'], 'stages.%s' % stage: 'pending'},
+                {'$set': {'stages.%s' % stage: 'queued', 'modified': datetime.utcnow()}}
+            )
+            if queued:
+                self.put(stage, payload['body_id'], [run['_id']])
+
+    def skip_descendants(self, run, module):
+        skipped = {}
+        for stage in self.get_descendants(module)[1:]:
+            if run['stages'].get(stage) == 'pending':
+                skipped['stages.%s' % stage] = 'skipped'
+        if skipped:
+            self.collection.update_one({'_id': run['_id']}, {'$set': skipped})
+
+    def reopen_descendants(self, run, module):
+        """
+        Stages skipped because module failed or expired are pending again after module succeeded, unless
+        another of their dependencies failed.
+        """
+        reopened = {}
+        for stage in self.get_descendants(module)[1:]:
+            if run['stages'].get(stage) != 'skipped':
+                continue
+            if any(run['stages'].get(ancestor) == 'failed' for ancestor in self.get_ancestors(stage)):
+                continue
+            reopened['stages.%s' % stage] = 'pending'
+        if not reopened:
+            return run
+        return self.collection.find_one_and_update(
+            {'_id': run['_id']},
+            {'$set': reopened},
+            return_document=ReturnDocument.AFTER
+        )
+
+    def set_stage_status(self, run_id, module, status):
+        # running lists the running stages, so expire_stages finds them with an index
+        update = {'$set': {'stages.%s' % module: status, 'modified': datetime.utcnow()}}
+        if status == 'running':
+            update['$addToSet'] = {'running': module}
+        else:
+            update['$pull'] = {'running': module}
+        return self.collection.find_one_and_update(
+            {'_id': run_id},
+            update,
+            return_document=ReturnDocument.AFTER
+        )
@@ -27,4 +27,5 @@ from .region import Region
 from .option import Option
 from .location_origin import LocationOrigin
 from .keyword_usergenerated import KeywordUsergenerated
-from .user import User
\ No newline at end of file
+from .user import User
+from .list_page import ListPage
\ No newline at end of file
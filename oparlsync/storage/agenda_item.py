@@ -16,6 +16,13 @@ from .oparl_document import OParlDocument
 
 
 class AgendaItem(Document, OParlDocument):
+    meta = {
+        'indexes': [
+            ('body', 'originalId', 'id'),
+            ('body', 'mirrorId', 'id')
+        ]
+    }
+
     type = 'https://schema.oparl.org/1.0/AgendaItem'
     body = ReferenceField('Body', dbref=False, deref_paper_location=False)
     meeting = ReferenceField('Meeting', dbref=False, deref_paper_location=False)
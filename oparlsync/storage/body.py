@@ -45,6 +45,7 @@ class Body(Document, OParlDocument):
     mirrorId = StringField(vendor_attribute=True)
     lastSync = DateTimeField(datetime_format='datetime', vendor_attribute=True)
     statistics = DictField(vendor_attribute=True)
+    watermark = DictField(vendor_attribute=True)
 
     # Felder zur Verarbeitung
     _object_db_name = 'body'
@@ -22,7 +22,13 @@ class File(Document, OParlDocument):
                 'fields': ['$name', "$text", 'body'],
                 'default_language': 'english',
                 'weights': {'name': 10, 'text': 2}
-            }
+            },
+            ('body', 'binaryChecksum'),
+            ('body', 'textStatus', 'id'),
+            ('downloadedChecksum', 'thumbnailStatus'),
+            ('body', 'georeferencesGenerated'),
+            ('body', 'originalId', 'id'),
+            ('body', 'mirrorId', 'id')
         ]
     }
 
@@ -63,6 +69,10 @@ class File(Document, OParlDocument):
     originalWeb = StringField(vendor_attribute=True)
     originalAccessUrl = StringField(vendor_attribute=True)
     originalDownloadUrl = StringField(vendor_attribute=True)
+    originalEtag = StringField(vendor_attribute=True, delete_paper=True, delete_paper_location=True)
+    originalLastModified = StringField(vendor_attribute=True, delete_paper=True, delete_paper_location=True)
+    binaryChecksum = StringField(vendor_attribute=True, delete_paper=True, delete_paper_location=True)
+    downloadedChecksum = StringField(vendor_attribute=True, delete_paper=True, delete_paper_location=True)
     textGenerated = DateTimeField(datetime_format='datetime', vendor_attribute=True, delete_paper=True, delete_paper_location=True)
     textStatus = StringField(vendor_attribute=True, delete_paper=True, delete_paper_location=True)
     thumbnailGenerated = DateTimeField(datetime_format='datetime', vendor_attribute=True, delete_paper=True, delete_paper_location=True)
@@ -70,6 +80,7 @@ class File(Document, OParlDocument):
     georeferencesGenerated = DateTimeField(datetime_format='datetime', vendor_attribute=True, delete_paper=True, delete_paper_location=True)
     georeferencesStatus = StringField(vendor_attribute=True, delete_paper=True, delete_paper_location=True)
     thumbnail = DictField(vendor_attribute=True, delete_paper=True, delete_paper_location=True)
+    thumbnailFormat = StringField(vendor_attribute=True, delete_paper=True, delete_paper_location=True)
     pages = IntField(vendor_attribute=True, delete_paper=True, delete_paper_location=True)
     keywordUsergenerated = ListField(ReferenceField('KeywordUsergenerated', deref_paper_location=False, deref_paper=False), vendor_attribute=True)
 
@@ -16,6 +16,13 @@ from .oparl_document import OParlDocument
 
 
 class Location(Document, OParlDocument):
+    meta = {
+        'indexes': [
+            ('body', 'originalId', 'id'),
+            ('body', 'mirrorId', 'id')
+        ]
+    }
+
     type = 'https://schema.oparl.org/1.0/Location'
     description = StringField(fulltext=True)
     geojson = DictField(geojson=True, delete_street=True)
@@ -16,6 +16,13 @@ from .oparl_document import OParlDocument
 
 
 class Meeting(Document, OParlDocument):
+    meta = {
+        'indexes': [
+            ('body', 'originalId', 'id'),
+            ('body', 'mirrorId', 'id')
+        ]
+    }
+
     type = 'https://schema.oparl.org/1.0/Meeting'
     body = ReferenceField('Body', dbref=False, deref_paper_location=False)
     name = StringField(fulltext=True)
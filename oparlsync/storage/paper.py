@@ -16,6 +16,13 @@ from .oparl_document import OParlDocument
 
 
 class Paper(Document, OParlDocument):
+    meta = {
+        'indexes': [
+            ('body', 'originalId', 'id'),
+            ('body', 'mirrorId', 'id')
+        ]
+    }
+
     type = 'https://schema.oparl.org/1.0/Paper'
     body = ReferenceField('Body', dbref=False, deref_paper_location=False, deref_paper=False)
     name = StringField(fulltext=True, sortable=True)
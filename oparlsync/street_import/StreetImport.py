@@ -12,7 +12,6 @@ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
 
 import os
 import json
-import requests
 import subprocess
 from geojson import Feature
 from ..storage import Street, StreetNumber, Region
@@ -54,7 +53,10 @@ class StreetImport():
 
         # download and uncompress geofabrik data
         self.main.datalog.debug('downloading http://download.geofabrik.de/%s' % self.region_config['geofabrik_package'])
-        r = requests.get('http://download.geofabrik.de/%s' % self.region_config['geofabrik_package'], stream=True)
+        r = self.main.http_get('http://download.geofabrik.de/%s' % self.region_config['geofabrik_package'], stream=True)
+        if not r or r.status_code != 200:
+            self.main.datalog.error('fatal: geofabrik package %s could not be downloaded' % self.region_config['geofabrik_package'])
+            return
         with open(os.path.join(self.main.config.TMP_OSM_DIR, region_id + '-geofabrik.osm.bz2'), 'wb') as f:
             for chunk in r.iter_content(chunk_size=1024):
                 if chunk:
@@ -65,8 +67,11 @@ class StreetImport():
 
         # download relation
         self.main.datalog.debug('downloading osm relation %s' % self.region_config['osm_relation'])
-        r = requests.get('https://www.openstreetmap.org/api/0.6/relation/%s/full' % self.region_config['osm_relation'],
-                         stream=True)
+        r = self.main.http_get('https://www.openstreetmap.org/api/0.6/relation/%s/full' % self.region_config['osm_relation'],
+                               stream=True)
+        if not r or r.status_code != 200:
+            self.main.datalog.error('fatal: osm relation %s could not be downloaded' % self.region_config['osm_relation'])
+            return
         with open(os.path.join(self.main.config.TMP_OSM_DIR, region_id + '.rel'), 'wb') as f:
             for chunk in r.iter_content(chunk_size=1024):
                 if chunk:
@@ -12,16 +12,17 @@ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
 
 import os
 import sys
-import time
 import signal
 import pymongo
 import logging
 import smtplib
+import threading
 import traceback
 from multiprocessing import Process
 from setproctitle import setproctitle
 from .config import get_config
 from .mongoqueue import MongoQueue
+from .pipeline import Pipeline
 
 from oparlsync.oparl_download import OparlDownload
 from oparlsync.generate_thumbnails import GenerateThumbnails
@@ -59,58 +60,55 @@ class Worker(Process):
 
 
     def run(self):
-        self.tick = 0
         self.load_config()
         self.init_statuslog()
         self.init_queue()
-
-        if self.config.ENABLE_PROCESSING:
-            self.next_job = {
-                'oparl_download': ['generate_backrefs', 'generate_thumbnails'],
-                'generate_backrefs': ['generate_fulltext'],
-                'generate_fulltext': ['generate_georeferences'],
-                'generate_georeferences': ['elasticsearch_import'],
-                'elasticsearch_import': ['misc', 'generate_sitemap']
-            }
-        else:
-            self.next_job = {
-                'oparl_download': ['generate_backrefs']
-            }
         #self.common = Common(prefix=self.process_name)
         setproctitle('%s worker: idle ' % (self.config.PROJECT_NAME))
         self.statuslog.info('Process %s started!' % self.process_name)
         while True:
-            if self.tick % 100 == 0:
-                job = self.queue_network.next()
-
-                if job:
+            # blocks until a job is put into the queue, so chained jobs start at once
+            job = self.queue_network.wait(self.config.QUEUE_WAIT_TIME)
+            if job:
+                current_module = None
+                successful = False
+                heartbeat_stop = threading.Event()
+                heartbeat = threading.Thread(target=self.heartbeat, args=(job, heartbeat_stop), daemon=True)
+                heartbeat.start()
+                try:
+                    self.pipeline.stage_started(job.payload)
+                    setproctitle('%s worker: %s %s ' % (self.config.PROJECT_NAME, job.payload['module'], job.payload['body_id']))
+                    #self.common.update_datalog(job.payload['module'], job.payload['body_id'])
+                    current_module = self.modules[job.payload['module']](job.payload['body_id'])
+                    current_module.run(job.payload['body_id'])
+                    successful = True
+                except:
+                    self.send_mail(
+                        self.config.ADMINS,
+                        'critical error at oparl-mirror',
+                        "Body ID: %s\nBacktrace:\n%s" % (job.payload['body_id'], traceback.format_exc())
+                    )
+                finally:
+                    heartbeat_stop.set()
+                    heartbeat.join()
+                    if current_module:
+                        current_module.close()
+                    self.pipeline.stage_finished(job.payload, successful)
+                    job.complete()
                     current_module = None
-                    try:
-                        setproctitle('%s worker: %s %s ' % (self.config.PROJECT_NAME, job.payload['module'], job.payload['body_id']))
-                        #self.common.update_datalog(job.payload['module'], job.payload['body_id'])
-                        current_module = self.modules[job.payload['module']](job.payload['body_id'])
-                        current_module.run(job.payload['body_id'])
-                    except:
-                        self.send_mail(
-                            self.config.ADMINS,
-                            'critical error at oparl-mirror',
-                            "Body ID: %s\nBacktrace:\n%s" % (job.payload['body_id'], traceback.format_exc())
-                        )
-                    finally:
-                        if current_module:
-                            current_module.close()
-                        self.add_next_to_queue(job.payload['module'], job.payload['body_id'])
-                        job.complete()
-                        current_module = None
-                        setproctitle('%s worker: idle ' % (self.config.PROJECT_NAME))
-            if self.tick >= 100000:
-                self.tick = 0
-            self.tick += 1
-            time.sleep(.1)
+                    setproctitle('%s worker: idle ' % (self.config.PROJECT_NAME))
+            else:
+                self.pipeline.expire_stages()
             if self.do_shutdown.value == 1:
                 self.graceful_shutdown()
                 break
 
+    def heartbeat(self, job, stop):
+        # keeps the lock of the running job fresh, so it does not count as stale
+        while not stop.wait(self.config.QUEUE_HEARTBEAT_TIME):
+            job.progress()
+            self.pipeline.stage_alive(job.payload)
+
     def graceful_shutdown(self):
         print("Shutdown of %s complete!" % self.process_name)
 
@@ -130,19 +128,10 @@ class Worker(Process):
         self.queue_network = MongoQueue(
             db_raw.queue_network,
             consumer_id="main",
-            timeout=300,
+            timeout=self.config.QUEUE_LOCK_TIMEOUT,
             max_attempts=3
         )
-
-
-    def add_next_to_queue(self, current_module, body_id):
-        if current_module in self.next_job.keys():
-            for next_module in self.next_job[current_module]:
-                payload = {
-                    'module': next_module,
-                    'body_id': body_id
-                }
-                self.queue_network.put(payload)
+        self.pipeline = Pipeline(db_raw, self.queue_network, self.config.ENABLE_PROCESSING, self.config.PIPELINE_RUN_TTL)
 
 
     def load_config(self):